@@ -152,6 +152,8 @@ export default function ChatPage() {
   const [showSplash, setShowSplash] = useState(true);
   const [isStreaming, setIsStreaming] = useState(false);
   const [abortController, setAbortController] = useState<AbortController | null>(null);
+  // Server-side id of the generation being streamed, so Stop can cancel it
+  const streamIdRef = useRef<string | null>(null);
   const [streamingEnabled, setStreamingEnabled] = useState(true);
 
   useEffect(() => {
@@ -161,6 +163,13 @@ export default function ChatPage() {
 
   const stopGeneration = () => {
     if (abortController) {
+      if (streamIdRef.current) {
+        // Stop the generation on the server too, so only what was shown is saved
+        fetch(`${process.env.NEXT_PUBLIC_BACKEND_URL}/chat/stream/${streamIdRef.current}`, {
+          method: "DELETE",
+        }).catch(() => {});
+        streamIdRef.current = null;
+      }
       abortController.abort();
       setAbortController(null);
       setIsStreaming(false);
@@ -478,6 +487,7 @@ export default function ChatPage() {
                 
                 switch (data.type) {
                   case 'session_info':
+                    streamIdRef.current = data.stream_id || null;
                     if (data.session_id && data.session_id !== sessionId) {
                       finalSessionId = data.session_id;
                     }
@@ -550,6 +560,7 @@ export default function ChatPage() {
 
       setIsStreaming(false);
       setAbortController(null);
+      streamIdRef.current = null;
       setLatency(latencyValue);
 
     } catch (error: any) {
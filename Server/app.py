@@ -1,38 +1,103 @@
-from flask import Flask, request, jsonify, send_file, Response
-import requests
+from flask import Blueprint, Flask, request, jsonify, send_file, Response
 from datetime import datetime
 import io
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
-import google.generativeai as genai
-from flask_pymongo import PyMongo
+import pymongo
 from bson import ObjectId
+from bson.errors import InvalidId
+from werkzeug.exceptions import HTTPException
 from datetime import datetime, timedelta
-import fitz
-import json
 import time
 
 load_dotenv() 
 
-app = Flask(__name__)
-CORS(app)
-app.config['CORS_HEADERS'] = 'Content-Type'
+# Local modules read their settings from the environment when imported
+import metrics
+import ollama_pool
+from model_catalog import catalog
+from mentions import build_mention_context
+import message_store
+import pdf_extract
+import blob_store
+import media_prep
+import response_cache
+from coalesce import generations
+import conversation
+import session_search
+import write_behind
+import retrieval
+import chat_streams
+from clients import mongo, gemini_model
 
-# Configure Gemini API
-GEMINI_API_KEY=os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel("models/gemini-1.5-flash-latest")
-
-# Connect MongoDB
 MONGODB_URL = os.getenv("MONGODB_URL")
-app.config["MONGO_URI"] = MONGODB_URL
-mongo = PyMongo(app)
+# Seconds /ready waits for MongoDB to answer a ping
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "2"))
+
+# Routes live on a blueprint so create_app() can build any number of apps
+bp = Blueprint("api", __name__)
+
+def create_app():
+    """Build the Flask app.
+
+    Nothing here touches the network: Mongo and Gemini clients are created
+    per process on first use (see clients.py), so importing this module is
+    fast and it is safe to fork workers after it, e.g. gunicorn --preload.
+    """
+    app = Flask(__name__)
+    CORS(app)
+    app.config['CORS_HEADERS'] = 'Content-Type'
+    # Reject oversized uploads before reading them (plus some room for the form fields)
+    app.config['MAX_CONTENT_LENGTH'] = blob_store.UPLOAD_MAX_BYTES + 1024 * 1024
+    app.config["MONGO_URI"] = MONGODB_URL
+    mongo.init_app(app)
+    app.register_blueprint(bp)
+    return app
+
+# ====== Metrics ======
+@bp.before_app_request
+def start_timer():
+    request.environ["request_start"] = time.perf_counter()
+
+@bp.after_app_request
+def observe_request(response):
+    start = request.environ.get("request_start")
+    if start is not None and request.url_rule is not None:
+        metrics.REQUEST_SECONDS.labels(
+            request.url_rule.rule, request.method, response.status_code
+        ).observe(time.perf_counter() - start)
+    return response
+
+@bp.route("/metrics")
+def prometheus_metrics():
+    body, content_type = metrics.export()
+    return Response(body, mimetype=content_type)
+
+# Readiness: 200 once this worker can reach MongoDB, 503 otherwise
+@bp.route("/ready")
+def ready():
+    checks = {}
+    try:
+        with pymongo.timeout(READY_TIMEOUT):
+            mongo.db.command("ping")
+        checks["mongo"] = "ok"
+    except Exception as e:
+        checks["mongo"] = f"unavailable: {e.__class__.__name__}"
+    ollama_pool.pool.start_health_checks()
+    backends = ollama_pool.pool.status()["backends"]
+    if not any(b["probed"] for b in backends):
+        checks["ollama"] = "unprobed"
+    else:
+        healthy = sum(b["probed"] and b["healthy"] for b in backends)
+        checks["ollama"] = f"{healthy}/{len(backends)} backends healthy"
+    checks["gemini"] = "configured" if gemini_model.configured else "no GEMINI_API_KEY"
 
-sessions_collection = mongo.db.sessions
+    ok = checks["mongo"] == "ok"
+    return jsonify({"ready": ok, "checks": checks}), 200 if ok else 503
 
 # Test mongodb connection
-@app.route("/mongo-test")
+@bp.route("/mongo-test")
 def mongo_test():
     try:
         count = mongo.db.sessions.count_documents({})
@@ -41,30 +106,31 @@ def mongo_test():
         return f"MongoDB connection failed: {str(e)}", 500
 
 def get_available_models():
-    try:
-        res = requests.get("http://localhost:11434/api/tags", timeout=5)
-        return sorted(set(m['name'].split(":")[0] for m in res.json().get("models", [])))
-    except:
-        return []
+    return catalog.names()
 
-@app.route("/models")
+@bp.route("/models")
 def models():
     local_models=get_available_models()
     cloud_models=["gemini"]
     return jsonify({
         "local_models": local_models,
+        "local_model_details": catalog.get(),
         "cloud_models": cloud_models,
     })
 
-@app.route("/select_model", methods=["POST"])
+@bp.route("/select_model", methods=["POST"])
 def select_model():
     global current_model
     current_model = request.json.get("model", "phi3")
+    catalog.record_use(current_model)
     return jsonify({"status": "ok"})
 
-@app.route("/chat", methods=["POST"])
+@bp.route("/chat", methods=["POST"])
 def chat():
     try:
+        timings = metrics.start_request()
+        include_timings = request.form.get("timings") == "1"
+
         # ====== Base form data ======
         user_msg = request.form.get("message", "")
         model_type = request.form.get("model_type", "")
@@ -75,15 +141,13 @@ def chat():
 
         # Mentions: fetch context
         mention_session_ids = request.form.getlist("mention_session_ids[]")
+        # Reads below must see this session's (and the mentioned ones') queued writes
+        write_behind.wait_for(mongo.db, [session_id, *mention_session_ids])
         history_context = ""
         if mention_session_ids:
             print(mention_session_ids)
-            for m_id in mention_session_ids:
-                if ObjectId.is_valid(m_id):
-                    s = mongo.db.sessions.find_one({"_id": ObjectId(m_id)})
-                    if s:
-                        for m in s.get("messages", []):
-                            history_context += f"{m['role']}: {m['content']}\n"
+            with timings.phase("mentions"):
+                history_context = build_mention_context(mongo.db, mention_session_ids, query=user_msg)
         if history_context:
             combined_input = (
                 f"Here is some previous conversation context that you should consider:\n"
@@ -95,98 +159,186 @@ def chat():
             combined_input = user_msg
         
         # ====== File Handling (optional) ======
-        uploaded_file = request.files.get("uploaded_file")
-        if uploaded_file:
-            if not allowed_file(uploaded_file.filename):
-                return jsonify({"error": "Unsupported file type"}), 400
-            if uploaded_file.filename == "":
-                return jsonify({"error": "Empty file"}), 400
-
-            file_bytes = uploaded_file.read()
-            file_ext = uploaded_file.filename.rsplit(".", 1)[-1].lower()
-
-            if model_type == "local":
-                return jsonify({"error": "Selected local model does not support files"}), 400
+        attachment, error = get_request_attachment(model_type)
+        if error:
+            return error
+        if attachment:
+            file_ext = attachment["name"].rsplit(".", 1)[-1].lower()
+
+            # Preprocess file for Gemini
+            if file_ext == "pdf":
+                combined_input = "".join([
+                    combined_input, "\n\n[PDF Content Extracted]\n", pdf_prompt_text(attachment, user_msg, timings)
+                ]).rstrip()
             else:
-                # Preprocess file for Gemini
-                if file_ext == "pdf":
-                    extracted_text = extract_text_from_pdf_bytes(file_bytes)
-                    combined_input = f"{combined_input}\n\n[PDF Content Extracted]\n{extracted_text}"
-                else:
-                    # For image/video/etc, handle as media input
-                    # Here gemini_model accepts both text + media
-                    response = gemini_model.generate_content([
-                        combined_input,
-                        {"mime_type": uploaded_file.mimetype or "image/jpeg", "data": file_bytes}
-                    ])
-                    latency_ms = 0
-                    bot_reply = response.text or "No reply."
-                    # Save to DB (with uploaded_file info)
-                    return save_and_return(session_id, session_name, model_name, user_msg, bot_reply, uploaded_file, file_bytes)
+                # For image/video/etc, handle as media input
+                # Here gemini_model accepts both text + media, shrunk to fit the media budget
+                cache_key = response_cache.make_key(model_type, model_name, combined_input, attachment["sha256"])
+                bot_reply = response_cache.lookup(mongo.db, cache_key)
+                if bot_reply is not None:
+                    return save_and_return(session_id, session_name, model_name, user_msg, bot_reply, attachment,
+                                           cache_status="hit", timings=timings if include_timings else None)
+                with timings.phase("media_prep"):
+                    media = media_prep.prepare(attachment)
+                start = time.perf_counter()
+                response = gemini_model.generate_content([combined_input, *media.parts])
+                timings.add("generation", time.perf_counter() - start)
+                latency_ms = int((time.perf_counter() - start) * 1000)
+                bot_reply = response.text or "No reply."
+                response_cache.store(mongo.db, cache_key, response.text, model_name)
+                # Save to DB (with uploaded_file info)
+                return save_and_return(session_id, session_name, model_name, user_msg, bot_reply, attachment,
+                                       media.stats(), latency_ms=latency_ms, timings=timings if include_timings else None)
 
         # ====== Model Handling (text only or text+mentions) ======
         bot_reply = "No reply."
+        reply_failed = False
         latency_ms = 0
+        # Local models get the session's earlier turns too (see conversation.py)
+        local_messages = None
         if model_type == "local":
-            payload = {
-                "model": model_name,
-                "prompt": combined_input,
-                "stream": False,
-            }
+            with timings.phase("history"):
+                local_messages = conversation.build_messages(mongo.db, session_id, combined_input)
+        cache_key = response_cache.make_key(
+            model_type, model_name, combined_input, attachment["sha256"] if attachment else None,
+            history=local_messages[:-1] if local_messages else None,
+        )
+        lookup_start = datetime.now()
+        cached_reply = response_cache.lookup(mongo.db, cache_key)
+        cache_status = "miss"
+        if cached_reply is not None:
+            bot_reply = cached_reply
+            latency_ms = int((datetime.now() - lookup_start).total_seconds() * 1000)
+            cache_status = "hit"
+        elif model_type == "local":
+            catalog.record_use(model_name)
+            client_id = get_client_id()
+            ollama_pool.pool.check_admission(model_name, client_id)
             try:
                 latency_ms = datetime.now()
-                response = requests.post("http://localhost:11434/api/generate", json=payload, timeout=60)
+                # Identical requests already in flight share one generation
+                flight = generations.join(cache_key, lambda flight: local_stream(
+                    model_name, local_messages, client_id, timings, session_id, cancel=flight
+                ))
+                reply = "".join(timings.stream(flight.stream()))
                 latency_ms = int((datetime.now() - latency_ms).total_seconds() * 1000)
-                bot_reply = response.json().get("response", "No reply.")
+                bot_reply = reply or "No reply."
+                response_cache.store(mongo.db, cache_key, reply, model_name)
+            except (ollama_pool.PoolBusy, ollama_pool.ModelNotFound):
+                raise
             except Exception as e:
                 bot_reply = f"Local model error: {str(e)}"
+                reply_failed = True
         else:
             try:
                 if model_name == "gemini":
                     print(combined_input)
                     latency_ms = datetime.now()
-                    response = gemini_model.generate_content(combined_input)
+                    flight = generations.join(cache_key, lambda flight: gemini_stream(combined_input))
+                    reply = "".join(timings.stream(flight.stream()))
                     latency_ms = int((datetime.now() - latency_ms).total_seconds() * 1000)
-                    bot_reply = response.text or "No Reply"
+                    bot_reply = reply or "No Reply"
+                    response_cache.store(mongo.db, cache_key, reply, model_name)
             except Exception as e:
                 bot_reply = f"Cloud model error: {str(e)}"
+                reply_failed = True
 
         # ====== Message Format ======
         messages = [
             {"role": "user", "content": user_msg, "timestamp": user_timestamp},
             {"role": "bot", "content": bot_reply, "timestamp": datetime.now(), "model_name": model_name}
         ]
+        if reply_failed:
+            # Shown in the chat, but never sent back to the model as history
+            messages[1]["error"] = True
 
         # ====== Store in DB ======
-        if session_id != "1":
-            mongo.db.sessions.update_one(
-                {"_id": ObjectId(session_id)},
-                {"$push": {"messages": {"$each": messages}}},
-            )
-        else:
-            session_doc = {
-                "session_name": session_name or "How can I help you?",
-                "messages": messages,
-                "created_at": datetime.now(),
-            }
-            inserted = mongo.db.sessions.insert_one(session_doc)
-            session_id = str(inserted.inserted_id)
+        with timings.phase("save"):
+            if session_id != "1":
+                write_behind.append_messages(mongo.db, session_id, messages)
+            else:
+                session_id = write_behind.create_session(
+                    mongo.db, session_name or "How can I help you?", messages
+                )
 
-        return jsonify({
+        result = {
             "response": bot_reply,
             "session_id": session_id,
             "timestamp": messages[1]["timestamp"].isoformat(),
-            "latency": latency_ms
-        })
-
+            "latency": latency_ms,
+            "cache": cache_status,
+        }
+        if include_timings:
+            result["timings"] = timings.as_dict()
+        return jsonify(result)
+
+    except (ollama_pool.PoolBusy, write_behind.WriterBusy) as e:
+        return busy_response(e)
+    except ollama_pool.ModelNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except HTTPException as e:
+        return jsonify({"error": e.description}), e.code
     except Exception as e:
         print("Error in /chat:", e)
         return jsonify({"error": str(e)}), 500
 
 
-@app.route("/chat/stream", methods=["POST"])
+def sse_response(frames):
+    return Response(
+        frames,
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Headers': 'Cache-Control, Last-Event-ID'
+        }
+    )
+
+def resume_response(stream_id, last_event_id, stream_mode):
+    """Continue an in-progress stream after the last chunk the client saw."""
+    stream = chat_streams.get_stream(stream_id)
+    if not stream:
+        return None
+    last_stream_id, after = chat_streams.parse_last_event_id(last_event_id)
+    if last_stream_id != stream_id:
+        after = -1
+    return sse_response(stream.view(after, stream_mode))
+
+@bp.route("/chat/stream/<stream_id>", methods=["GET"])
+def resume_chat_stream(stream_id):
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id", "")
+    stream_mode = chat_streams.parse_stream_mode(request.args.get("stream_mode"))
+    response = resume_response(stream_id, last_event_id, stream_mode)
+    if response is None:
+        return jsonify({"error": "Stream not found or expired"}), 404
+    return response
+
+@bp.route("/chat/stream/<stream_id>", methods=["DELETE"])
+def cancel_chat_stream(stream_id):
+    """Stop a generation (the client's Stop button); only the text already sent is saved."""
+    stream = chat_streams.get_stream(stream_id)
+    if not stream:
+        return jsonify({"error": "Stream not found or expired"}), 404
+    stream.cancel()
+    return jsonify({"status": "cancelled", "stream_id": stream_id})
+
+@bp.route("/chat/stream", methods=["POST"])
 def chat_stream():
     try:
+        timings = metrics.start_request()
+        include_timings = request.form.get("timings") == "1"
+
+        # "token" sends one frame per chunk, "coalesced" batches chunks into fewer frames
+        stream_mode = chat_streams.parse_stream_mode(request.form.get("stream_mode"))
+
+        # A reconnecting client picks up its in-progress generation instead of starting a new one
+        last_stream_id, _ = chat_streams.parse_last_event_id(request.headers.get("Last-Event-ID"))
+        if last_stream_id:
+            response = resume_response(last_stream_id, request.headers.get("Last-Event-ID"), stream_mode)
+            if response is not None:
+                return response
+
         # ====== Base form data ======
         user_msg = request.form.get("message", "")
         model_type = request.form.get("model_type", "")
@@ -197,15 +349,13 @@ def chat_stream():
 
         # Mentions: fetch context
         mention_session_ids = request.form.getlist("mention_session_ids[]")
+        # Reads below must see this session's (and the mentioned ones') queued writes
+        write_behind.wait_for(mongo.db, [session_id, *mention_session_ids])
         history_context = ""
         if mention_session_ids:
             print(mention_session_ids)
-            for m_id in mention_session_ids:
-                if ObjectId.is_valid(m_id):
-                    s = mongo.db.sessions.find_one({"_id": ObjectId(m_id)})
-                    if s:
-                        for m in s.get("messages", []):
-                            history_context += f"{m['role']}: {m['content']}\n"
+            with timings.phase("mentions"):
+                history_context = build_mention_context(mongo.db, mention_session_ids, query=user_msg)
         if history_context:
             combined_input = (
                 f"Here is some previous conversation context that you should consider:\n"
@@ -217,146 +367,142 @@ def chat_stream():
             combined_input = user_msg
         
         # ====== File Handling (optional) ======
-        uploaded_file = request.files.get("uploaded_file")
-        if uploaded_file:
-            if not allowed_file(uploaded_file.filename):
-                return jsonify({"error": "Unsupported file type"}), 400
-            if uploaded_file.filename == "":
-                return jsonify({"error": "Empty file"}), 400
-
-            file_bytes = uploaded_file.read()
-            file_ext = uploaded_file.filename.rsplit(".", 1)[-1].lower()
-
-            if model_type == "local":
-                return jsonify({"error": "Selected local model does not support files"}), 400
+        attachment, error = get_request_attachment(model_type)
+        if error:
+            return error
+        if attachment:
+            file_ext = attachment["name"].rsplit(".", 1)[-1].lower()
+
+            # For file uploads, we'll use non-streaming for now
+            if file_ext == "pdf":
+                combined_input = "".join([
+                    combined_input, "\n\n[PDF Content Extracted]\n", pdf_prompt_text(attachment, user_msg, timings)
+                ]).rstrip()
             else:
-                # For file uploads, we'll use non-streaming for now
-                if file_ext == "pdf":
-                    extracted_text = extract_text_from_pdf_bytes(file_bytes)
-                    combined_input = f"{combined_input}\n\n[PDF Content Extracted]\n{extracted_text}"
-                else:
-                    response = gemini_model.generate_content([
-                        combined_input,
-                        {"mime_type": uploaded_file.mimetype or "image/jpeg", "data": file_bytes}
-                    ])
-                    bot_reply = response.text or "No reply."
-                    return save_and_return(session_id, session_name, model_name, user_msg, bot_reply, uploaded_file, file_bytes)
+                cache_key = response_cache.make_key(model_type, model_name, combined_input, attachment["sha256"])
+                bot_reply = response_cache.lookup(mongo.db, cache_key)
+                if bot_reply is not None:
+                    return save_and_return(session_id, session_name, model_name, user_msg, bot_reply, attachment,
+                                           cache_status="hit", timings=timings if include_timings else None)
+                with timings.phase("media_prep"):
+                    media = media_prep.prepare(attachment)
+                start = time.perf_counter()
+                response = gemini_model.generate_content([combined_input, *media.parts])
+                timings.add("generation", time.perf_counter() - start)
+                latency_ms = int((time.perf_counter() - start) * 1000)
+                bot_reply = response.text or "No reply."
+                response_cache.store(mongo.db, cache_key, response.text, model_name)
+                return save_and_return(session_id, session_name, model_name, user_msg, bot_reply, attachment,
+                                       media.stats(), latency_ms=latency_ms, timings=timings if include_timings else None)
+
+        # Local models get the session's earlier turns too (see conversation.py)
+        local_messages = None
+        if model_type == "local":
+            with timings.phase("history"):
+                local_messages = conversation.build_messages(mongo.db, session_id, combined_input)
+        cache_key = response_cache.make_key(
+            model_type, model_name, combined_input, attachment["sha256"] if attachment else None,
+            history=local_messages[:-1] if local_messages else None,
+        )
+        cached_reply = response_cache.lookup(mongo.db, cache_key)
+        cache_status = "hit" if cached_reply is not None else "miss"
+
+        on_cancel = None
+        if cached_reply is not None:
+            # Replay the cached reply in the same chunk events a live generation sends
+            source = response_cache.replay_chunks(cached_reply)
+        elif model_type == "local" or model_name == "gemini":
+            if model_type == "local":
+                catalog.record_use(model_name)
+                client_id = get_client_id()
+                # Reject before the stream starts if the Ollama pool can't take the request
+                ollama_pool.pool.check_admission(model_name, client_id)
+                upstream = lambda flight: local_stream(
+                    model_name, local_messages, client_id, timings, session_id, cancel=flight
+                )
+            else:  # Cloud model (Gemini)
+                upstream = lambda flight: gemini_stream(combined_input)
+            # Identical requests already in flight share one generation; each
+            # subscriber still gets every chunk from the start
+            source = generations.join(cache_key, upstream).stream()
+            # Stop (or a disconnect) ends the subscription at once, not at the next chunk
+            on_cancel = source.close
+        else:
+            source = iter(())
+        source = timings.stream(source)
+
+        def on_complete(reply):
+            if cached_reply is None:
+                response_cache.store(mongo.db, cache_key, reply, model_name)
+
+        # The generation runs and is checkpointed to the session independently of
+        # this connection. With resumable=1 a client that drops can resume it with
+        # Last-Event-ID; otherwise a disconnect stops it, as the Stop button expects
+        user_message = {"role": "user", "content": user_msg, "timestamp": user_timestamp}
+        checkpointer = chat_streams.ReplyCheckpointer(mongo.db, session_id, session_name, user_message, model_name)
+        stream = chat_streams.start_stream(
+            source, checkpointer, on_complete=on_complete, extra_complete={"cache": cache_status},
+            timings=timings if include_timings else None,
+            resumable=request.form.get("resumable") == "1", on_cancel=on_cancel,
+        )
 
         def generate_stream():
-            bot_reply = ""
-            start_time = datetime.now()
-            
             # Send session info first
-            yield f"data: {json.dumps({'type': 'session_info', 'session_id': session_id})}\n\n"
-            
-            try:
-                if model_type == "local":
-                    payload = {
-                        "model": model_name,
-                        "prompt": combined_input,
-                        "stream": True,
-                    }
-                    
-                    response = requests.post("http://localhost:11434/api/generate", json=payload, stream=True, timeout=60)
-                    response.raise_for_status()
-                    
-                    for line in response.iter_lines():
-                        if line:
-                            try:
-                                chunk_data = json.loads(line.decode('utf-8'))
-                                chunk_text = chunk_data.get("response", "")
-                                if chunk_text:
-                                    bot_reply += chunk_text
-                                    yield f"data: {json.dumps({'type': 'chunk', 'text': chunk_text})}\n\n"
-                                
-                                if chunk_data.get("done", False):
-                                    break
-                            except json.JSONDecodeError:
-                                continue
-                            except GeneratorExit:
-                                # Handle client disconnect/stop generation
-                                break
-                                
-                else:  # Cloud model (Gemini)
-                    if model_name == "gemini":
-                        # Gemini streaming
-                        response = gemini_model.generate_content(
-                            combined_input,
-                            stream=True
-                        )
-                        
-                        for chunk in response:
-                            try:
-                                chunk_text = chunk.text if chunk.text else ""
-                                if chunk_text:
-                                    bot_reply += chunk_text
-                                    yield f"data: {json.dumps({'type': 'chunk', 'text': chunk_text})}\n\n"
-                            except GeneratorExit:
-                                # Handle client disconnect/stop generation
-                                break
-                    
-            except Exception as e:
-                error_msg = f"Error: {str(e)}"
-                bot_reply = error_msg
-                yield f"data: {json.dumps({'type': 'error', 'message': error_msg})}\n\n"
-            
-            # Calculate latency
-            end_time = datetime.now()
-            latency_ms = int((end_time - start_time).total_seconds() * 1000)
-            
-            # Save to database only if we have some content
-            if bot_reply.strip():
-                messages = [
-                    {"role": "user", "content": user_msg, "timestamp": user_timestamp},
-                    {"role": "bot", "content": bot_reply, "timestamp": end_time, "model_name": model_name}
-                ]
-
-                final_session_id = session_id
-                if session_id != "1":
-                    mongo.db.sessions.update_one(
-                        {"_id": ObjectId(session_id)},
-                        {"$push": {"messages": {"$each": messages}}},
-                    )
-                else:
-                    session_doc = {
-                        "session_name": session_name or "How can I help you?",
-                        "messages": messages,
-                        "created_at": datetime.now(),
-                    }
-                    inserted = mongo.db.sessions.insert_one(session_doc)
-                    final_session_id = str(inserted.inserted_id)
-                
-                # Send completion message
-                yield f"data: {json.dumps({'type': 'complete', 'session_id': final_session_id, 'timestamp': end_time.isoformat(), 'latency': latency_ms})}\n\n"
-
-        return Response(
-            generate_stream(),
-            mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Cache-Control'
-            }
-        )
+            yield chat_streams.sse({'type': 'session_info', 'session_id': session_id, 'stream_id': stream.id})
+            yield from stream.view(mode=stream_mode)
 
+        return sse_response(generate_stream())
+
+    except (ollama_pool.PoolBusy, write_behind.WriterBusy) as e:
+        return busy_response(e)
+    except ollama_pool.ModelNotFound as e:
+        return jsonify({"error": str(e)}), 404
+    except HTTPException as e:
+        return jsonify({"error": e.description}), e.code
     except Exception as e:
         print("Error in /chat/stream:", e)
         return jsonify({"error": str(e)}), 500
 
 
-def save_and_return(session_id, session_name, model_name, user_msg, bot_reply, uploaded_file, file_bytes):
+def local_stream(model_name, messages, client_id=None, timings=None, session_id=None, cancel=None):
+    keep_alive = catalog.keep_alive_for(model_name)
+    return ollama_pool.stream_chat(
+        model_name, messages, client_id, keep_alive=keep_alive, timings=timings,
+        affinity=session_id if session_id != "1" else None, cancel=cancel,
+    )
+
+def get_client_id():
+    """Who a request counts against for Ollama queue fairness."""
+    return request.headers.get("X-Client-Id") or request.remote_addr
+
+def busy_response(e):
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(int(e.retry_after))
+    return response
+
+def gemini_stream(prompt):
+    stats = {}
+
+    def chunks():
+        for chunk in gemini_model.generate_content(prompt, stream=True):
+            usage = getattr(chunk, "usage_metadata", None)
+            if usage and getattr(usage, "candidates_token_count", 0):
+                stats["eval_count"] = usage.candidates_token_count
+            if chunk.text:
+                yield chunk.text
+
+    return metrics.track_generation(chunks(), "gemini", "gemini", stats)
+
+def save_and_return(session_id, session_name, model_name, user_msg, bot_reply, attachment, media_stats=None,
+                    cache_status="miss", latency_ms=0, timings=None):
     """Helper for media case to store and return."""
     messages = [
         {
             "role": "user",
             "content": user_msg,
             "timestamp": datetime.now() - timedelta(seconds=10),
-            "uploaded_file": {
-                "name": uploaded_file.filename,
-                "type": uploaded_file.mimetype,
-                "size": len(file_bytes),
-            },
+            "uploaded_file": attachment,
         },
         {
             "role": "bot",
@@ -366,30 +512,28 @@ def save_and_return(session_id, session_name, model_name, user_msg, bot_reply, u
         }
     ]
     if session_id != "1":
-        mongo.db.sessions.update_one(
-            {"_id": ObjectId(session_id)},
-            {
-                "$push": {"messages": {"$each": messages}},
-                "$set": {"session_name": session_name or "How can I help you?"}
-            },
+        write_behind.append_messages(
+            mongo.db, session_id, messages,
+            set_fields={"session_name": session_name or "How can I help you?"},
         )
     else:
-        session_doc = {
-            "messages": messages,
-            "created_at": datetime.now(),
-            "session_name": session_name or "How can I help you?",
-        }
-        inserted = mongo.db.sessions.insert_one(session_doc)
-        session_id = str(inserted.inserted_id)
+        session_id = write_behind.create_session(
+            mongo.db, session_name or "How can I help you?", messages
+        )
 
-    return jsonify({
+    result = {
         "response": bot_reply,
         "session_id": session_id,
         "timestamp": messages[1]["timestamp"].isoformat(),
-        "latency": 0
-    })
+        "latency": latency_ms,
+        "media": media_stats,
+        "cache": cache_status,
+    }
+    if timings is not None:
+        result["timings"] = timings.as_dict()
+    return jsonify(result)
 
-@app.route("/chat/history", methods=["POST"])
+@bp.route("/chat/history", methods=["POST"])
 def chat_history():
     data = request.json or {}
     id_list = data.get("session_ids", [])
@@ -398,40 +542,89 @@ def chat_history():
         object_ids = [ObjectId(sid) for sid in id_list]
     except Exception as e:
         return jsonify({"error": "Invalid session ID format"}), 400
+    write_behind.wait_for(mongo.db, id_list)
+
+    # Summary mode: names, recency, counts and a preview only, paged with a cursor
+    if data.get("summary"):
+        order_by = data.get("order_by", "updated_at")
+        if order_by not in ("updated_at", "created_at"):
+            return jsonify({"error": "order_by must be updated_at or created_at"}), 400
+        try:
+            limit = max(1, min(int(data.get("limit", 50)), message_store.MAX_PAGE_SIZE))
+            sessions, next_cursor = message_store.list_session_summaries(
+                mongo.db, object_ids, order_by=order_by, limit=limit, cursor=data.get("cursor")
+            )
+        except (TypeError, ValueError, InvalidId):
+            return jsonify({"error": "Invalid limit or cursor"}), 400
+        return jsonify({"sessions": sessions, "next_cursor": next_cursor})
 
-    sessions = mongo.db.sessions.find({"_id": {"$in": object_ids}}).sort("created_at", -1)
+    sessions = list(mongo.db.sessions.find({"_id": {"$in": object_ids}}).sort("created_at", -1))
+    messages_by_session = message_store.get_messages_for_sessions(
+        mongo.db, [session["_id"] for session in sessions]
+    )
 
     result = []
     for session in sessions:
+        session["messages"] = [message_store.serialize_message(msg) for msg in messages_by_session[session["_id"]]]
         session["_id"] = str(session["_id"])
-        for msg in session.get("messages", []):
-            msg["timestamp"] = msg["timestamp"].isoformat()
         result.append(session)
     
     return jsonify(result)
 
-@app.route("/chat/<session_id>", methods=["GET"])
+@bp.route("/chat/search", methods=["POST"])
+def search_chats():
+    data = request.json or {}
+    query = (data.get("query") or "").strip()
+    if not query:
+        return jsonify({"error": "Missing query"}), 400
+
+    try:
+        object_ids = [ObjectId(sid) for sid in data.get("session_ids", [])]
+        limit = max(1, min(int(data.get("limit", 20)), session_search.SEARCH_MAX_PAGE_SIZE))
+        offset = max(0, int(data.get("offset", 0)))
+    except (TypeError, ValueError, InvalidId):
+        return jsonify({"error": "Invalid session ID, limit or offset"}), 400
+
+    try:
+        write_behind.wait_for(mongo.db, data.get("session_ids", []))
+        sessions, messages, next_offset = session_search.search(
+            mongo.db, object_ids, query, limit=limit, offset=offset
+        )
+        return jsonify({"sessions": sessions, "messages": messages, "next_offset": next_offset})
+    except Exception as e:
+        return jsonify({"error": f"Search failed: {str(e)}"}), 500
+
+@bp.route("/chat/<session_id>", methods=["GET"])
 def get_session_messages(session_id):
+    # Optional cursor pagination: ?limit=50 returns the newest page,
+    # ?before=<next_before>&limit=50 the page before it
     try:
-        session = mongo.db.sessions.find_one({"_id": ObjectId(session_id)})
+        before = request.args.get("before")
+        before = int(before) if before is not None else None
+        limit = request.args.get("limit")
+        if limit is not None:
+            limit = max(1, min(int(limit), message_store.MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Invalid before or limit"}), 400
 
-        if not session:
-            return jsonify({"error": "Session not found"}), 404
+    try:
+        write_behind.wait_for(mongo.db, [session_id])
+        page = message_store.get_messages(mongo.db, session_id, before=before, limit=limit)
 
-        # Convert timestamps to ISO format for JSON serialization
-        for msg in session.get("messages", []):
-            if "timestamp" in msg:
-                msg["timestamp"] = msg["timestamp"].isoformat()
+        if page is None:
+            return jsonify({"error": "Session not found"}), 404
 
+        messages, next_before = page
         return jsonify({
-            "session_id": str(session["_id"]),
-            "messages": session["messages"]
+            "session_id": session_id,
+            "messages": messages,
+            "next_before": next_before,
         })
 
     except Exception as e:
         return jsonify({"error": f"Invalid session ID: {str(e)}"}), 400
 
-@app.route("/chat/rename", methods=["POST"])
+@bp.route("/chat/rename", methods=["POST"])
 def rename_session():
     data = request.json or {}
     session_id = data.get("session_id")
@@ -441,6 +634,7 @@ def rename_session():
         return jsonify({"error": "Missing session_id or new_name"}), 400
 
     try:
+        write_behind.wait_for(mongo.db, [session_id])
         result = mongo.db.sessions.update_one(
             {"_id": ObjectId(session_id)},
             {"$set": {"session_name": new_name}}
@@ -454,7 +648,7 @@ def rename_session():
     except Exception as e:
         return jsonify({"error": f"Failed to rename session: {str(e)}"}), 500
     
-@app.route("/clear", methods=["POST"])
+@bp.route("/clear", methods=["POST"])
 def clear():
     data = request.get_json()
     session_id = data.get("session_id")
@@ -463,12 +657,8 @@ def clear():
         return jsonify({"error": "Missing session_id"}), 400
 
     try:
-        result = mongo.db.sessions.update_one(
-            {"_id": ObjectId(session_id)},
-            {"$set": {"messages": []}}
-        )
-
-        if result.matched_count == 0:
+        write_behind.wait_for(mongo.db, [session_id])
+        if not message_store.clear_session(mongo.db, session_id):
             return jsonify({"error": "Session not found"}), 404
 
         return jsonify({"status": "cleared", "session_id": session_id})
@@ -476,24 +666,66 @@ def clear():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-for m in genai.list_models():
-    print(m.name, m.supported_generation_methods)
-
 # Allowed image extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'mp4', 'pdf', 'mp3'}
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf_bytes(file_bytes: bytes) -> str:
-    text = ""
-    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
-        for page in doc:
-            text += page.get_text()
-            text += "\n\n"
-    return text.strip()
-
-@app.route("/chat/delete/<session_id>", methods=["DELETE"])
+def get_request_attachment(model_type):
+    """Attachment for this chat turn: a new upload, or a previous one re-sent by hash.
+
+    Returns (attachment, error_response).
+    """
+    uploaded_file = request.files.get("uploaded_file")
+    attachment_id = request.form.get("attachment_id", "")
+    if not uploaded_file and not attachment_id:
+        return None, None
+
+    if model_type == "local":
+        return None, (jsonify({"error": "Selected local model does not support files"}), 400)
+
+    if uploaded_file:
+        if not allowed_file(uploaded_file.filename):
+            return None, (jsonify({"error": "Unsupported file type"}), 400)
+        if uploaded_file.filename == "":
+            return None, (jsonify({"error": "Empty file"}), 400)
+        try:
+            return blob_store.save_upload(mongo.db, uploaded_file), None
+        except ValueError as e:
+            return None, (jsonify({"error": str(e)}), 413)
+
+    attachment = blob_store.get_attachment(mongo.db, attachment_id)
+    if not attachment:
+        return None, (jsonify({"error": "Attachment not found, please upload the file again"}), 404)
+    return attachment, None
+
+@bp.route("/files/<sha256>", methods=["GET"])
+def get_file(sha256):
+    attachment = blob_store.get_attachment(mongo.db, sha256)
+    if not attachment:
+        return jsonify({"error": "File not found"}), 404
+    return send_file(
+        blob_store.blob_path(sha256),
+        mimetype=attachment["type"] or "application/octet-stream",
+        download_name=attachment["name"],
+    )
+
+def pdf_prompt_text(attachment, query, timings):
+    """A PDF's text for the prompt, or only its most relevant excerpts if it is long."""
+    sha256 = attachment["sha256"]
+    with timings.phase("pdf_extract"):
+        text = pdf_extract.extract_text(blob_store.blob_path(sha256), key=sha256)
+    if retrieval.RETRIEVAL and query and len(text) > retrieval.RETRIEVAL_PDF_MIN_CHARS:
+        try:
+            with timings.phase("retrieval"):
+                excerpts = retrieval.pdf_context(sha256, text, query, retrieval.RETRIEVAL_PDF_MIN_CHARS)
+            return "[Most relevant excerpts]\n" + excerpts
+        except Exception as e:
+            print("Retrieval over PDF failed, using the full text:", e)
+    return text
+
+@bp.route("/chat/delete/<session_id>", methods=["DELETE"])
 def delete_chat(session_id):
     try:
         # Validate session_id
@@ -501,9 +733,8 @@ def delete_chat(session_id):
             return jsonify({"error": "Invalid session_id"}), 400
 
         # Attempt to delete
-        result = mongo.db.sessions.delete_one({"_id": ObjectId(session_id)})
-
-        if result.deleted_count == 0:
+        write_behind.wait_for(mongo.db, [session_id])
+        if not message_store.delete_session(mongo.db, session_id):
             return jsonify({"error": "Chat session not found"}), 404
 
         return jsonify({"status": "success", "message": "Chat deleted successfully"})
@@ -512,4 +743,4 @@ def delete_chat(session_id):
         return jsonify({"error": str(e)}), 500
     
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
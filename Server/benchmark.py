@@ -0,0 +1,365 @@
+"""Offline load test for the chat server.
+
+Runs the app in-process against local stand-ins, so no Ollama, Gemini or
+MongoDB is needed:
+
+- a fake Ollama server that streams tokens at --token-rate per second,
+- a stubbed Gemini model that streams at the same rate,
+- mongomock in place of MongoDB (pip install mongomock).
+
+It then drives the chosen endpoints over HTTP at the given concurrency and
+prints request count, errors, requests/sec and p50/p99 latency for each
+scenario. Streaming scenarios also report p50/p99 time to first token. The
+load generator shares a process (and the GIL) with the server, so compare
+numbers between runs on the same machine rather than against production.
+
+    python benchmark.py
+    python benchmark.py --scenarios stream,history --concurrency 32 --requests 500
+    python benchmark.py --token-rate 100 --tokens 256 --json results.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SCENARIOS = ("chat", "stream", "history", "pdf")
+LOCAL_MODEL = "bench:latest"
+
+
+# ====== Stand-ins ======
+
+class FakeOllama(BaseHTTPRequestHandler):
+    """Just enough of the Ollama API for the app: tags, ps, generate and chat."""
+
+    protocol_version = "HTTP/1.1"
+    token_rate = 50.0
+    tokens = 64
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, body):
+        line = (json.dumps(body) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json({"models": [{"name": LOCAL_MODEL, "size": 0, "details": {"family": "bench"}}]})
+        elif self.path == "/api/ps":
+            self._send_json({"models": [{"name": LOCAL_MODEL}]})
+        else:
+            self._send_json({})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self.path not in ("/api/generate", "/api/chat"):
+            self._send_json({})
+            return
+        if not payload.get("prompt") and not payload.get("messages"):
+            # Prewarm request
+            self._send_json({"done": True})
+            return
+        if self.path == "/api/chat":
+            def chunk(text):
+                return {"message": {"role": "assistant", "content": text}}
+        else:
+            def chunk(text):
+                return {"response": text}
+        start = time.perf_counter()
+        if not payload.get("stream"):
+            time.sleep(self.tokens / self.token_rate)
+            self._send_json({**chunk("tok " * self.tokens), "done": True})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for _ in range(self.tokens):
+                time.sleep(1 / self.token_rate)
+                self._send_chunk({**chunk("tok "), "done": False})
+            self._send_chunk({
+                **chunk(""), "done": True, "eval_count": self.tokens,
+                "eval_duration": int((time.perf_counter() - start) * 1e9),
+            })
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class _OllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The app drops keep-alive connections once it has read the final message
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _GeminiChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiModel:
+    token_rate = 50.0
+    tokens = 64
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def _chunks(self):
+        for _ in range(self.tokens):
+            time.sleep(1 / self.token_rate)
+            yield _GeminiChunk("tok ")
+
+    def generate_content(self, contents, stream=False):
+        if stream:
+            return self._chunks()
+        time.sleep(self.tokens / self.token_rate)
+        return _GeminiChunk("tok " * self.tokens)
+
+
+def install_stand_ins(args):
+    """Start the fake Ollama and patch Gemini and Mongo. Must run before importing app."""
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("The benchmark needs mongomock: pip install mongomock")
+    import flask_pymongo
+    import google.generativeai as genai
+
+    FakeOllama.token_rate = FakeGeminiModel.token_rate = args.token_rate
+    FakeOllama.tokens = FakeGeminiModel.tokens = args.tokens
+    ollama = _OllamaServer(("127.0.0.1", 0), FakeOllama)
+    threading.Thread(target=ollama.serve_forever, daemon=True).start()
+    ollama_url = f"http://127.0.0.1:{ollama.server_port}"
+    os.environ["OLLAMA_URL"] = ollama_url
+    os.environ["OLLAMA_BACKENDS"] = ollama_url
+    os.environ.setdefault("OLLAMA_BACKEND_MAX_INFLIGHT", str(args.concurrency))
+    os.environ["UPLOAD_DIR"] = tempfile.mkdtemp(prefix="privgpt-bench-")
+    os.environ.setdefault("MONGODB_URL", "mongodb://localhost/bench")
+
+    class MockPyMongo:
+        def __init__(self, app=None, *a, **kw):
+            self.cx = mongomock.MongoClient()
+            self.db = self.cx["bench"]
+
+    flask_pymongo.PyMongo = MockPyMongo
+    genai.configure = lambda **kw: None
+    genai.list_models = lambda: []
+    genai.GenerativeModel = FakeGeminiModel
+
+
+# ====== Scenarios ======
+
+def _form(i, **fields):
+    # A distinct prompt per request, so the reply cache and coalescing don't short-circuit it
+    return {"message": f"benchmark request {i}", "session_id": "1", **fields}
+
+
+def run_chat(base_url, i, ctx):
+    start = time.perf_counter()
+    res = requests.post(f"{base_url}/chat", data=_form(i, model_type="local", model_name=LOCAL_MODEL))
+    res.raise_for_status()
+    return time.perf_counter() - start, None
+
+
+def run_stream(base_url, i, ctx):
+    start = time.perf_counter()
+    ttft = None
+    with requests.post(
+        f"{base_url}/chat/stream", data=_form(i, model_type="local", model_name=LOCAL_MODEL), stream=True
+    ) as res:
+        res.raise_for_status()
+        for line in res.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            event = json.loads(line[6:])
+            if event["type"] == "chunk" and ttft is None:
+                ttft = time.perf_counter() - start
+            elif event["type"] == "error":
+                raise RuntimeError(event["message"])
+    return time.perf_counter() - start, ttft
+
+
+def run_history(base_url, i, ctx):
+    start = time.perf_counter()
+    res = requests.post(f"{base_url}/chat/history", json={"session_ids": ctx["session_ids"]})
+    res.raise_for_status()
+    return time.perf_counter() - start, None
+
+
+def run_pdf(base_url, i, ctx):
+    pdf = ctx["pdfs"][i]
+    start = time.perf_counter()
+    res = requests.post(
+        f"{base_url}/chat",
+        data=_form(i, model_type="cloud", model_name="gemini"),
+        files={"uploaded_file": (f"bench-{i}.pdf", pdf, "application/pdf")},
+    )
+    res.raise_for_status()
+    return time.perf_counter() - start, None
+
+
+RUNNERS = {"chat": run_chat, "stream": run_stream, "history": run_history, "pdf": run_pdf}
+
+
+def seed_sessions(db, count, messages_per_session):
+    import message_store
+
+    session_ids = []
+    for s in range(count):
+        messages = [
+            {"role": "user" if m % 2 == 0 else "bot", "content": f"seeded message {m} " * 20}
+            for m in range(messages_per_session)
+        ]
+        session_ids.append(message_store.create_session(db, f"Bench session {s}", messages))
+    return session_ids
+
+
+def make_pdfs(count, pages):
+    import fitz
+
+    pdfs = []
+    for i in range(count):
+        doc = fitz.open()
+        for p in range(pages):
+            # Unique text per file, so every upload is extracted rather than served from cache
+            doc.new_page().insert_text((72, 72), f"Benchmark document {i}, page {p}. " * 3)
+        pdfs.append(doc.tobytes())
+        doc.close()
+    return pdfs
+
+
+# ====== Runner ======
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def run_scenario(name, base_url, args, ctx):
+    runner = RUNNERS[name]
+    latencies, ttfts, errors = [], [], []
+    lock = threading.Lock()
+
+    def one(i):
+        try:
+            latency, ttft = runner(base_url, i, ctx)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        with lock:
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 1)
+
+    return {
+        "scenario": name,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "req_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "ttft_p50_ms": ms(percentile(ttfts, 50)),
+        "ttft_p99_ms": ms(percentile(ttfts, 99)),
+    }
+
+
+def print_report(results):
+    columns = ("scenario", "requests", "errors", "req_per_sec", "p50_ms", "p99_ms", "ttft_p50_ms", "ttft_p99_ms")
+    print(" ".join(f"{c:>12}" for c in columns))
+    for result in results:
+        print(" ".join(f"{'-' if result[c] is None else result[c]:>12}" for c in columns))
+        if result["first_error"]:
+            print(f"  first error: {result['first_error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma separated, from {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100, help="requests per scenario")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="fake model tokens per second")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per fake reply")
+    parser.add_argument("--sessions", type=int, default=20, help="sessions fetched by the history scenario")
+    parser.add_argument("--session-messages", type=int, default=50)
+    parser.add_argument("--pdf-pages", type=int, default=20)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the server's own output")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    install_stand_ins(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from werkzeug.serving import make_server
+
+    import app as server
+
+    httpd = make_server("127.0.0.1", 0, server.create_app(), threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{httpd.server_port}"
+
+    ctx = {}
+    if "history" in scenarios:
+        ctx["session_ids"] = seed_sessions(server.mongo.db, args.sessions, args.session_messages)
+    if "pdf" in scenarios:
+        ctx["pdfs"] = make_pdfs(args.requests, args.pdf_pages)
+
+    print(f"{args.concurrency} concurrent clients, {args.requests} requests per scenario, "
+          f"fake models at {args.token_rate:g} tokens/s x {args.tokens} tokens")
+    if args.verbose:
+        results = [run_scenario(name, base_url, args, ctx) for name in scenarios]
+    else:
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = [run_scenario(name, base_url, args, ctx) for name in scenarios]
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    httpd.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Content-addressed storage for chat attachments.
+
+Uploads are streamed to disk in chunks while being hashed, then stored
+under their sha256 so identical files are kept once. A small `uploads`
+document per hash remembers the original name and type, which lets a later
+message re-send an attachment by hash without uploading it again.
+"""
+import hashlib
+import os
+import re
+import tempfile
+from datetime import datetime
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+CHUNK_SIZE = 1024 * 1024
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_valid_hash(sha256):
+    return bool(sha256) and bool(_SHA256_RE.match(sha256))
+
+
+def blob_path(sha256):
+    return os.path.join(UPLOAD_DIR, sha256[:2], sha256)
+
+
+def save_upload(db, file_storage):
+    """Store an uploaded werkzeug FileStorage. Returns its attachment record."""
+    tmp_dir = os.path.join(UPLOAD_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+        try:
+            while True:
+                chunk = file_storage.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise ValueError(f"File exceeds the {UPLOAD_MAX_BYTES} byte limit")
+                digest.update(chunk)
+                tmp.write(chunk)
+        except Exception:
+            tmp.close()
+            os.unlink(tmp.name)
+            raise
+
+    sha256 = digest.hexdigest()
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        # Duplicate content, keep the copy we already have
+        os.unlink(tmp.name)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp.name, path)
+
+    attachment = {
+        "sha256": sha256,
+        "name": file_storage.filename,
+        "type": file_storage.mimetype,
+        "size": size,
+    }
+    db.uploads.update_one(
+        {"_id": sha256},
+        {
+            "$setOnInsert": {"name": attachment["name"], "type": attachment["type"],
+                             "size": size, "created_at": datetime.now()},
+            "$set": {"last_used_at": datetime.now()},
+        },
+        upsert=True,
+    )
+    return attachment
+
+
+def get_attachment(db, sha256):
+    """Attachment record for a previously uploaded file, or None."""
+    if not is_valid_hash(sha256) or not os.path.exists(blob_path(sha256)):
+        return None
+    doc = db.uploads.find_one({"_id": sha256})
+    if not doc:
+        return None
+    return {"sha256": sha256, "name": doc.get("name"), "type": doc.get("type"), "size": doc.get("size")}
+
+
+def read_blob(sha256):
+    with open(blob_path(sha256), "rb") as f:
+        return f.read()
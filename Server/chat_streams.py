@@ -0,0 +1,347 @@
+"""Resumable /chat/stream generations with incremental checkpointing.
+
+A ChatStream consumes the generation on its own thread, independent of the
+HTTP connection that started it. It checkpoints the partial reply to the
+session every few seconds or chunks, and keeps the chunks it has seen so
+that any number of SSE viewers can follow along. Each chunk event carries
+an id of the form "<stream_id>:<index>". A client that drops its
+connection can reconnect with Last-Event-ID and continue from the next
+chunk. Streams are only held open like this when the request opts in
+with resumable=1. If nobody reconnects within STREAM_RESUME_GRACE
+seconds, the generation is cancelled. Other streams are cancelled as soon
+as their viewer disconnects, as before. DELETE /chat/stream/<id> (the
+client's Stop button) cancels one explicitly. A cancelled stream keeps
+only the part of the reply that was already sent.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from bson import ObjectId
+
+import metrics
+import write_behind
+
+STREAM_CHECKPOINT_SECONDS = float(os.getenv("STREAM_CHECKPOINT_SECONDS", "2"))
+STREAM_CHECKPOINT_CHUNKS = int(os.getenv("STREAM_CHECKPOINT_CHUNKS", "32"))
+STREAM_RESUME_GRACE = float(os.getenv("STREAM_RESUME_GRACE", "15"))
+# How long a finished stream can still be replayed by a reconnecting client
+STREAM_RETENTION = float(os.getenv("STREAM_RETENTION", "60"))
+# "coalesced" gathers chunks into one frame per window, "token" sends every chunk
+STREAM_MODE = os.getenv("STREAM_MODE", "coalesced")
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "30"))
+STREAM_COALESCE_MAX_BYTES = int(os.getenv("STREAM_COALESCE_MAX_BYTES", "4096"))
+STREAM_MODES = ("coalesced", "token")
+
+
+def sse(payload, event_id=None):
+    frame = f"data: {json.dumps(payload)}\n\n"
+    return f"id: {event_id}\n{frame}" if event_id is not None else frame
+
+
+class ReplyCheckpointer:
+    """Writes a reply to its session in batches while it is being generated.
+
+    Nothing is written until there is some text. The first flush stores the
+    user message and a bot message flagged `streaming`. Later flushes
+    rewrite that bot message's content, and finish() clears the flag, or
+    deletes the bot message if it ends up empty (cancelled before any of it
+    was sent).
+    """
+
+    def __init__(self, db, session_id, session_name, user_message, model_name):
+        self.db = db
+        self.session_id = session_id
+        self.session_name = session_name
+        self.user_message = user_message
+        self.model_name = model_name
+        self.parts = []
+        # Set when the reply is an error message rather than model output
+        self.error = False
+        # Later checkpoints address the bot message by this id
+        self.bot_id = ObjectId()
+        self.stored = False
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+
+    def text(self):
+        return "".join(self.parts)
+
+    def add(self, text):
+        self.parts.append(text)
+        self._unflushed += 1
+        if (self._unflushed >= STREAM_CHECKPOINT_CHUNKS
+                or time.monotonic() - self._last_flush >= STREAM_CHECKPOINT_SECONDS):
+            self.flush()
+
+    def flush(self, final=False, end_time=None):
+        reply = self.text()
+        self._unflushed = 0
+        self._last_flush = time.monotonic()
+        if not reply.strip():
+            if final and self.stored:
+                write_behind.delete_message(self.db, self.session_id, self.bot_id)
+                self.stored = False
+            return
+        timestamp = end_time or datetime.now()
+        if not self.stored:
+            bot_message = {
+                "_id": self.bot_id, "role": "bot", "content": reply, "timestamp": timestamp,
+                "model_name": self.model_name,
+            }
+            if not final:
+                bot_message["streaming"] = True
+            if self.error:
+                bot_message["error"] = True
+            messages = [self.user_message, bot_message]
+            if self.session_id != "1":
+                write_behind.append_messages(self.db, self.session_id, messages)
+            else:
+                self.session_id = write_behind.create_session(
+                    self.db, self.session_name or "How can I help you?", messages
+                )
+            self.stored = True
+        elif final:
+            fields = {"content": reply, "timestamp": timestamp}
+            if self.error:
+                fields["error"] = True
+            write_behind.update_message(self.db, self.session_id, self.bot_id, fields, unset_fields=["streaming"])
+        else:
+            write_behind.update_message(self.db, self.session_id, self.bot_id, {"content": reply})
+
+    def finish(self, end_time):
+        self.flush(final=True, end_time=end_time)
+        return self.session_id
+
+
+class ChatStream:
+    def __init__(self, stream_id, source, checkpointer, on_complete=None, extra_complete=None, timings=None,
+                 resume_grace=0, on_cancel=None):
+        self.id = stream_id
+        self.source = source
+        self.checkpointer = checkpointer
+        self.on_complete = on_complete
+        self.extra_complete = extra_complete or {}
+        # Reported in the complete event when set
+        self.timings = timings
+        self.chunks = []
+        self.error = None
+        self.complete = None
+        self.done = False
+        self.finished_at = None
+        self.cancelled = False
+        # Seconds to wait for a reconnect once the last viewer is gone; 0 cancels at once
+        self.resume_grace = resume_grace
+        # Called on cancel() so a worker blocked on the source wakes up now
+        self.on_cancel = on_cancel
+        self.viewers = 0
+        # Chunks already handed to a viewer; all that is kept if the stream is cancelled
+        self.delivered = 0
+        self.start_time = datetime.now()
+        self._cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        if self.timings is not None:
+            metrics.bind(self.timings)
+        try:
+            for text in self.source:
+                if self.cancelled:
+                    break
+                self.checkpointer.add(text)
+                with self._cond:
+                    self.chunks.append(text)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = f"Error: {str(e)}"
+            # As before, the error text is what gets saved as the reply
+            self.checkpointer.parts = [self.error]
+            self.checkpointer.error = True
+        finally:
+            close = getattr(self.source, "close", None)
+            if close:
+                close()
+        if self.cancelled:
+            # Don't save text the user never saw
+            self.checkpointer.parts = self.chunks[:self.delivered]
+            self.checkpointer.error = False
+
+        end_time = datetime.now()
+        latency_ms = int((end_time - self.start_time).total_seconds() * 1000)
+        session_id = self.checkpointer.session_id
+        save_start = time.perf_counter()
+        try:
+            session_id = self.checkpointer.finish(end_time)
+        except Exception as e:
+            print("Error saving streamed reply:", e)
+        if self.timings is not None:
+            self.timings.add("save", time.perf_counter() - save_start)
+        if self.error is None and not self.cancelled and self.on_complete:
+            self.on_complete(self.checkpointer.text())
+
+        with self._cond:
+            if self.checkpointer.text().strip():
+                self.complete = {
+                    "type": "complete",
+                    "session_id": session_id,
+                    "timestamp": end_time.isoformat(),
+                    "latency": latency_ms,
+                    **self.extra_complete,
+                }
+                if self.timings is not None:
+                    self.complete["timings"] = self.timings.as_dict()
+            self.done = True
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+
+    def _pending_bytes(self, index):
+        return sum(len(text.encode("utf-8")) for text in self.chunks[index:])
+
+    def view(self, after=-1, mode=STREAM_MODE):
+        """SSE frames for one viewer, starting after chunk index `after`.
+
+        In "coalesced" mode the first chunk is sent as soon as it arrives.
+        After that, chunks are held for up to STREAM_COALESCE_MS or until
+        STREAM_COALESCE_MAX_BYTES have piled up, and sent as one frame whose
+        id is that of its last chunk, so Last-Event-ID resumes still line up.
+        """
+        coalesce = mode == "coalesced" and STREAM_COALESCE_MS > 0
+        window = STREAM_COALESCE_MS / 1000
+        with self._cond:
+            self.viewers += 1
+        index = after + 1
+        first = True
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self.chunks) and not self.done:
+                        self._cond.wait()
+                    if coalesce and not first:
+                        deadline = time.monotonic() + window
+                        while not self.done and self._pending_bytes(index) < STREAM_COALESCE_MAX_BYTES:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            self._cond.wait(remaining)
+                    pending = self.chunks[index:]
+                    done = self.done
+                if not coalesce:
+                    for text in pending:
+                        yield sse({"type": "chunk", "text": text}, f"{self.id}:{index}")
+                        index += 1
+                        self._mark_delivered(index)
+                else:
+                    for group in _frames(pending):
+                        index += len(group)
+                        yield sse({"type": "chunk", "text": "".join(group)}, f"{self.id}:{index - 1}")
+                        self._mark_delivered(index)
+                if pending:
+                    first = False
+                if done and index >= len(self.chunks):
+                    break
+            if self.error:
+                yield sse({"type": "error", "message": self.error})
+            if self.complete:
+                yield sse(self.complete)
+        finally:
+            self._leave()
+
+    def _mark_delivered(self, count):
+        with self._cond:
+            self.delivered = max(self.delivered, count)
+
+    def _leave(self):
+        with self._cond:
+            self.viewers -= 1
+            if self.viewers > 0 or self.done:
+                return
+        if self.resume_grace <= 0:
+            self.cancel()
+            return
+        # Give the client a chance to reconnect before giving up on the generation
+        timer = threading.Timer(self.resume_grace, self._cancel_if_abandoned)
+        timer.daemon = True
+        timer.start()
+
+    def _cancel_if_abandoned(self):
+        with self._cond:
+            abandoned = self.viewers == 0
+        if abandoned:
+            self.cancel()
+
+    def cancel(self):
+        """Stop the generation, keeping only the chunks already sent."""
+        with self._cond:
+            if self.done or self.cancelled:
+                return
+            # The worker stops and closes the source, which releases the
+            # upstream generation
+            self.cancelled = True
+        if self.on_cancel:
+            self.on_cancel()
+
+
+def _frames(chunks):
+    """Group chunks into runs of at most STREAM_COALESCE_MAX_BYTES (one chunk minimum)."""
+    group, size = [], 0
+    for text in chunks:
+        text_bytes = len(text.encode("utf-8"))
+        if group and size + text_bytes > STREAM_COALESCE_MAX_BYTES:
+            yield group
+            group, size = [], 0
+        group.append(text)
+        size += text_bytes
+    if group:
+        yield group
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+def _prune():
+    now = time.monotonic()
+    for stream_id, stream in list(_streams.items()):
+        if stream.done and now - stream.finished_at > STREAM_RETENTION:
+            del _streams[stream_id]
+
+
+def start_stream(source, checkpointer, on_complete=None, extra_complete=None, timings=None, resumable=False,
+                 on_cancel=None):
+    """Start a generation; `resumable` keeps it alive for STREAM_RESUME_GRACE after a disconnect.
+
+    `on_cancel` should make the source stop at once (e.g. Subscription.close)
+    so a cancel doesn't wait for the next chunk.
+    """
+    stream = ChatStream(
+        uuid.uuid4().hex, source, checkpointer, on_complete, extra_complete, timings,
+        resume_grace=STREAM_RESUME_GRACE if resumable else 0, on_cancel=on_cancel,
+    )
+    with _streams_lock:
+        _prune()
+        _streams[stream.id] = stream
+    stream.start()
+    return stream
+
+
+def get_stream(stream_id):
+    with _streams_lock:
+        return _streams.get(stream_id)
+
+
+def parse_stream_mode(value):
+    return value if value in STREAM_MODES else STREAM_MODE
+
+
+def parse_last_event_id(last_event_id):
+    """Split "<stream_id>:<index>" into its parts, or (None, -1)."""
+    stream_id, _, index = (last_event_id or "").partition(":")
+    try:
+        return stream_id or None, int(index)
+    except ValueError:
+        return stream_id or None, -1
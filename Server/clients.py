@@ -0,0 +1,82 @@
+"""Process-local Mongo and Gemini clients, created on first use.
+
+Importing the app must stay cheap and must not touch the network, so that
+it boots fast, works offline and can be loaded once before a prefork
+server (gunicorn --preload) forks its workers. Neither client is built at
+import. Each process builds its own client the first time it needs one;
+one inherited across a fork is replaced, since MongoClient and gRPC
+channels are not fork-safe. google.generativeai is only imported then too.
+"""
+import os
+import threading
+
+GEMINI_MODEL_NAME = "models/gemini-1.5-flash-latest"
+
+
+class LazyMongo:
+    """Stand-in for flask_pymongo.PyMongo that connects on first `.db` access."""
+
+    def __init__(self):
+        self._app = None
+        self._mongo = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        from flask_pymongo.helpers import BSONObjectIdConverter, BSONProvider
+
+        self._app = app
+        # What PyMongo.init_app sets up besides the client, so responses
+        # serialize the same before and after the first query
+        app.url_map.converters["ObjectId"] = BSONObjectIdConverter
+        app.json = BSONProvider(app)
+
+    def _get(self):
+        if self._mongo is None or self._pid != os.getpid():
+            with self._lock:
+                if self._mongo is None or self._pid != os.getpid():
+                    from flask_pymongo import PyMongo
+
+                    self._mongo = PyMongo(self._app)
+                    self._pid = os.getpid()
+        return self._mongo
+
+    @property
+    def db(self):
+        return self._get().db
+
+    @property
+    def cx(self):
+        return self._get().cx
+
+
+class LazyGemini:
+    """Stand-in for a genai.GenerativeModel that is configured on first use."""
+
+    def __init__(self, model_name=GEMINI_MODEL_NAME):
+        self.model_name = model_name
+        self._model = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def configured(self):
+        return bool(os.getenv("GEMINI_API_KEY"))
+
+    def _get(self):
+        if self._model is None or self._pid != os.getpid():
+            with self._lock:
+                if self._model is None or self._pid != os.getpid():
+                    import google.generativeai as genai
+
+                    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+                    self._model = genai.GenerativeModel(self.model_name)
+                    self._pid = os.getpid()
+        return self._model
+
+    def generate_content(self, *args, **kwargs):
+        return self._get().generate_content(*args, **kwargs)
+
+
+mongo = LazyMongo()
+gemini_model = LazyGemini()
@@ -0,0 +1,167 @@
+"""Single-flight coalescing of identical in-flight generations.
+
+Requests with the same key (model + normalized prompt + attachment, see
+response_cache.make_key) share one upstream generation. The generation runs
+on its own thread and records every chunk, so each subscriber receives the
+full sequence from the first chunk no matter when it joined. When the last
+subscriber leaves before the end, the upstream generation is cancelled:
+the flight runs its on_cancel() callbacks, which the Ollama pool uses to
+leave its queue or drop the connection without waiting for a token.
+"""
+import os
+import threading
+
+COALESCE_GENERATIONS = os.getenv("COALESCE_GENERATIONS", "1") == "1"
+
+
+class Cancelled(Exception):
+    """The generation was stopped because every subscriber left."""
+
+
+class Flight:
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self.subscribers = 0
+        self._on_cancel = []
+        self._cond = threading.Condition()
+
+    def publish(self, text):
+        with self._cond:
+            self.chunks.append(text)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def on_cancel(self, callback):
+        """Call `callback` once the flight is cancelled (right away if it already is)."""
+        with self._cond:
+            if not self.cancelled:
+                self._on_cancel.append(callback)
+                return
+        callback()
+
+    def stream(self, start=0):
+        """A Subscription to the chunks from index `start` on."""
+        return Subscription(self, start)
+
+    def _join(self):
+        """Add a subscriber; False if the flight was already cancelled."""
+        with self._cond:
+            if self.cancelled:
+                return False
+            self.subscribers += 1
+            return True
+
+    def _leave(self):
+        with self._cond:
+            self.subscribers -= 1
+            if self.subscribers > 0 or self.done or self.cancelled:
+                return
+            # Nobody is listening any more, stop paying for the generation
+            self.cancelled = True
+            callbacks, self._on_cancel = self._on_cancel, []
+        for callback in callbacks:
+            callback()
+
+
+class Subscription:
+    """One subscriber's iterator over a flight's chunks.
+
+    Iteration ends with the flight, raising its error if it failed. close()
+    may be called from another thread and ends it at once, without waiting
+    for the next chunk. A subscription leaves its flight when it ends, is
+    closed or is dropped, whichever comes first.
+    """
+
+    def __init__(self, flight, start=0):
+        self.flight = flight
+        self.closed = False
+        self._index = start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        flight = self.flight
+        with flight._cond:
+            while self._index >= len(flight.chunks) and not flight.done and not self.closed:
+                flight._cond.wait()
+            closed = self.closed
+            if not closed and self._index < len(flight.chunks):
+                self._index += 1
+                return flight.chunks[self._index - 1]
+        self.close()
+        if not closed and flight.error is not None:
+            raise flight.error
+        raise StopIteration
+
+    def close(self):
+        flight = self.flight
+        with flight._cond:
+            if self.closed:
+                return
+            self.closed = True
+            flight._cond.notify_all()
+        flight._leave()
+
+    def __del__(self):
+        self.close()
+
+
+class Coalescer:
+    def __init__(self, enabled=COALESCE_GENERATIONS):
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, start_upstream):
+        """Subscribe to the generation for `key`, starting it if needed.
+
+        `start_upstream(flight)` is called on the worker thread and must
+        return an iterator of text chunks; it can hand the flight on as a
+        `cancel` to ollama_pool. Returns the Flight; iterate flight.stream().
+        """
+        with self._lock:
+            flight = self._flights.get(key) if self.enabled else None
+            # The count and `cancelled` share the flight's lock, so a join can't
+            # race the last subscriber leaving
+            if flight is None or not flight._join():
+                flight = Flight(key)
+                flight._join()
+                if self.enabled:
+                    self._flights[key] = flight
+                threading.Thread(target=self._run, args=(flight, start_upstream), daemon=True).start()
+        return flight
+
+    def _run(self, flight, start_upstream):
+        upstream = None
+        try:
+            upstream = iter(start_upstream(flight))
+            for text in upstream:
+                if flight.cancelled:
+                    break
+                flight.publish(text)
+            if flight.cancelled:
+                # Never let a truncated reply pass for a complete one
+                raise Cancelled("Generation cancelled")
+            flight.finish()
+        except Exception as e:
+            flight.finish(e)
+        finally:
+            # Closing a generator upstream (e.g. the Ollama stream) drops its connection
+            if hasattr(upstream, "close"):
+                upstream.close()
+            with self._lock:
+                if self._flights.get(flight.key) is flight:
+                    del self._flights[flight.key]
+
+
+generations = Coalescer()
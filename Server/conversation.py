@@ -0,0 +1,71 @@
+"""Multi-turn message lists for local models.
+
+Local turns go to Ollama's /api/chat with the session's earlier messages
+ahead of the new one. Ollama keeps the KV cache of the last prompt it
+processed for a loaded model. When the next turn starts with the same
+messages, only the new tokens have to be prefilled. The pool sends a
+session back to the backend that served it last, for the same reason.
+
+Replies saved from a failed turn (flagged `error`) are left out; they are
+not model output, and resending them would only pollute the context.
+
+Once the history passes LOCAL_HISTORY_MAX_CHARS, the oldest messages are
+dropped. The window start moves in steps of LOCAL_HISTORY_STEP messages
+rather than one message per turn, so the prompt prefix, and with it the
+cache, stays the same for several turns between steps.
+"""
+import os
+
+from bson.errors import InvalidId
+
+import message_store
+
+LOCAL_HISTORY = os.getenv("LOCAL_HISTORY", "1") == "1"
+# Characters (~4 per token) of earlier messages sent along; keep below the model's num_ctx
+LOCAL_HISTORY_MAX_CHARS = int(os.getenv("LOCAL_HISTORY_MAX_CHARS", "12000"))
+LOCAL_HISTORY_STEP = int(os.getenv("LOCAL_HISTORY_STEP", "8"))
+# Upper bound on the messages loaded to build the window
+LOCAL_HISTORY_MAX_MESSAGES = 200
+
+ROLES = {"user": "user", "bot": "assistant"}
+
+
+def _window_start(history, budget):
+    """seq of the first message to keep so the rest fits in `budget` characters."""
+    total = sum(len(m["content"]) for m in history)
+    start = 0
+    while start < len(history) and total > budget:
+        total -= len(history[start]["content"])
+        start += 1
+    if start == 0:
+        return history[0]["seq"] if history else 0
+    if start == len(history):
+        return history[-1]["seq"] + 1
+    # Round up to a step boundary of the absolute seq, so the window only
+    # moves when it crosses one
+    seq = history[start]["seq"]
+    step = max(1, LOCAL_HISTORY_STEP)
+    return -(-seq // step) * step
+
+
+def build_messages(db, session_id, prompt):
+    """Ollama chat messages for a turn: earlier messages in the session, then `prompt`."""
+    history = []
+    if LOCAL_HISTORY and session_id != "1":
+        try:
+            page = message_store.get_messages(db, session_id, limit=LOCAL_HISTORY_MAX_MESSAGES)
+        except InvalidId:
+            page = None
+        if page:
+            history = [
+                m for m in page[0]
+                if m.get("role") in ROLES and m.get("content")
+                and not m.get("streaming") and not m.get("error")
+            ]
+    start_seq = _window_start(history, LOCAL_HISTORY_MAX_CHARS - len(prompt))
+    messages = [
+        {"role": ROLES[m["role"]], "content": m["content"]}
+        for m in history if m["seq"] >= start_seq
+    ]
+    messages.append({"role": "user", "content": prompt})
+    return messages
@@ -0,0 +1,166 @@
+"""Shrink image/video/audio attachments before they are sent to Gemini.
+
+Images are downscaled and recompressed with Pillow, videos are sampled into
+a handful of frames and audio is trimmed and downsampled with ffmpeg. If a
+tool is missing or a step fails, the original file is sent unchanged.
+Results are cached by the attachment's sha256.
+"""
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+import blob_store
+
+MEDIA_PREPROCESS = os.getenv("MEDIA_PREPROCESS", "1") == "1"
+MEDIA_IMAGE_MAX_SIDE = int(os.getenv("MEDIA_IMAGE_MAX_SIDE", "1536"))
+MEDIA_IMAGE_QUALITY = int(os.getenv("MEDIA_IMAGE_QUALITY", "85"))
+MEDIA_VIDEO_FRAMES = int(os.getenv("MEDIA_VIDEO_FRAMES", "8"))
+MEDIA_VIDEO_FRAME_SIDE = int(os.getenv("MEDIA_VIDEO_FRAME_SIDE", "768"))
+MEDIA_AUDIO_MAX_SECONDS = int(os.getenv("MEDIA_AUDIO_MAX_SECONDS", "600"))
+MEDIA_AUDIO_BITRATE = os.getenv("MEDIA_AUDIO_BITRATE", "32k")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+FFMPEG = shutil.which("ffmpeg")
+FFPROBE = shutil.which("ffprobe")
+
+
+class PreparedMedia:
+    def __init__(self, parts, original_bytes):
+        self.parts = parts
+        self.original_bytes = original_bytes
+        self.sent_bytes = sum(len(p["data"]) for p in parts if isinstance(p, dict))
+
+    def stats(self):
+        return {
+            "original_bytes": self.original_bytes,
+            "sent_bytes": self.sent_bytes,
+            "bytes_saved": max(0, self.original_bytes - self.sent_bytes),
+        }
+
+
+class _Cache:
+    def __init__(self, max_bytes=MEDIA_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is not None:
+                self._entries.move_to_end(key)
+            return prepared
+
+    def put(self, key, prepared):
+        if prepared.sent_bytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = prepared
+            self._bytes += prepared.sent_bytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.sent_bytes
+
+
+_cache = _Cache()
+
+
+def _shrink_image(data):
+    # Pillow is imported on the first image, not when the server starts
+    try:
+        from PIL import Image
+    except ImportError:  # Pillow is optional, images are sent as-is without it
+        return None
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail((MEDIA_IMAGE_MAX_SIDE, MEDIA_IMAGE_MAX_SIDE))
+        out = io.BytesIO()
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if has_alpha:
+            img.save(out, format="PNG", optimize=True)
+            mime_type = "image/png"
+        else:
+            img.convert("RGB").save(out, format="JPEG", quality=MEDIA_IMAGE_QUALITY, optimize=True)
+            mime_type = "image/jpeg"
+    return [{"mime_type": mime_type, "data": out.getvalue()}]
+
+
+def _video_duration(path):
+    result = subprocess.run(
+        [FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "json", path],
+        capture_output=True, timeout=30, check=True,
+    )
+    return float(json.loads(result.stdout)["format"]["duration"])
+
+
+def _sample_video_frames(path):
+    if not (FFMPEG and FFPROBE) or MEDIA_VIDEO_FRAMES <= 0:
+        return None
+    duration = _video_duration(path)
+    fps = MEDIA_VIDEO_FRAMES / max(duration, 0.001)
+    side = MEDIA_VIDEO_FRAME_SIDE
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        subprocess.run(
+            [FFMPEG, "-v", "error", "-i", path,
+             "-vf", f"fps={fps},scale='min({side},iw)':-2",
+             "-frames:v", str(MEDIA_VIDEO_FRAMES), "-q:v", "4",
+             os.path.join(tmp_dir, "frame_%03d.jpg")],
+            capture_output=True, timeout=120, check=True,
+        )
+        frames = []
+        for name in sorted(os.listdir(tmp_dir)):
+            with open(os.path.join(tmp_dir, name), "rb") as f:
+                frames.append({"mime_type": "image/jpeg", "data": f.read()})
+    if not frames:
+        return None
+    note = f"[The attached video ({duration:.0f}s) is given as {len(frames)} frames sampled evenly across it]"
+    return [note, *frames]
+
+
+def _downsample_audio(path):
+    if not FFMPEG:
+        return None
+    result = subprocess.run(
+        [FFMPEG, "-v", "error", "-i", path, "-t", str(MEDIA_AUDIO_MAX_SECONDS),
+         "-ac", "1", "-ar", "16000", "-b:a", MEDIA_AUDIO_BITRATE, "-f", "mp3", "pipe:1"],
+        capture_output=True, timeout=120, check=True,
+    )
+    return [{"mime_type": "audio/mpeg", "data": result.stdout}] if result.stdout else None
+
+
+def prepare(attachment):
+    """Gemini content parts for an image/video/audio attachment."""
+    sha256 = attachment["sha256"]
+    mime_type = attachment.get("type") or "image/jpeg"
+    key = (sha256, mime_type)
+    prepared = _cache.get(key)
+    if prepared is not None:
+        return prepared
+
+    path = blob_store.blob_path(sha256)
+    original_bytes = os.path.getsize(path)
+    parts = None
+    if MEDIA_PREPROCESS:
+        try:
+            if mime_type.startswith("image/"):
+                parts = _shrink_image(blob_store.read_blob(sha256))
+            elif mime_type.startswith("video/"):
+                parts = _sample_video_frames(path)
+            elif mime_type.startswith("audio/"):
+                parts = _downsample_audio(path)
+        except Exception as e:
+            print(f"Media preprocessing failed for {sha256}, sending original:", e)
+            parts = None
+
+    prepared = PreparedMedia(parts, original_bytes) if parts else None
+    if prepared is None or prepared.sent_bytes >= original_bytes:
+        # Nothing gained, send the file as uploaded (cheap to re-read, so not cached)
+        return PreparedMedia([{"mime_type": mime_type, "data": blob_store.read_blob(sha256)}], original_bytes)
+    _cache.put(key, prepared)
+    return prepared
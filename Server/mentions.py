@@ -0,0 +1,134 @@
+"""@mention context assembly: batched session reads, a size budget and a transcript cache."""
+import os
+import threading
+from collections import OrderedDict
+
+from bson import ObjectId
+
+import message_store
+import retrieval
+
+# Budget for the whole mentioned-history block (roughly 4 characters per token)
+MENTION_CONTEXT_MAX_CHARS = int(os.getenv("MENTION_CONTEXT_MAX_CHARS", "32000"))
+# Upper bound on rendered transcript text kept in memory across requests
+MENTION_CACHE_MAX_CHARS = int(os.getenv("MENTION_CACHE_MAX_CHARS", "8000000"))
+
+
+class TranscriptCache:
+    """LRU of rendered transcript lines keyed by (session id, version).
+
+    The version is the session's message count and updated_at. Appends
+    change the count, and clears and in-progress reply checkpoints bump
+    updated_at, so a cached rendering is current while both match.
+    """
+
+    def __init__(self, max_chars=MENTION_CACHE_MAX_CHARS):
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id, version):
+        with self._lock:
+            key = (session_id, version)
+            lines = self._entries.get(key)
+            if lines is not None:
+                self._entries.move_to_end(key)
+            return lines
+
+    def put(self, session_id, version, lines):
+        size = sum(len(line) for line in lines)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            # Older renderings of the same session can never be hit again
+            for key in [k for k in self._entries if k[0] == session_id]:
+                self._chars -= sum(len(line) for line in self._entries.pop(key))
+            self._entries[(session_id, version)] = lines
+            self._chars += size
+            while self._chars > self.max_chars:
+                _, evicted = self._entries.popitem(last=False)
+                self._chars -= sum(len(line) for line in evicted)
+
+
+transcript_cache = TranscriptCache()
+
+
+def render_messages(messages):
+    return [f"{m['role']}: {m['content']}\n" for m in messages]
+
+
+def _take_recent(lines, budget):
+    """Most recent lines that fit in budget, oldest first."""
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        if used + len(line) > budget:
+            break
+        kept.append(line)
+        used += len(line)
+    kept.reverse()
+    return kept, used
+
+
+def load_transcripts(db, session_ids):
+    """(session ObjectId, rendered transcript lines) for each valid id, in the order given."""
+    object_ids = list(dict.fromkeys(ObjectId(s) for s in session_ids if ObjectId.is_valid(s)))
+    if not object_ids:
+        return []
+
+    versions = {
+        s["_id"]: (s["message_count"], s.get("updated_at"))
+        for s in db.sessions.aggregate([
+            {"$match": {"_id": {"$in": object_ids}}},
+            # Legacy sessions embed their messages and have no message_count yet
+            {"$project": {"updated_at": 1, "message_count": {"$ifNull": [
+                "$message_count", {"$size": {"$ifNull": ["$messages", []]}}
+            ]}}},
+        ])
+    }
+    transcripts = {}
+    missing = []
+    for oid, version in versions.items():
+        lines = transcript_cache.get(str(oid), version)
+        if lines is None:
+            missing.append(oid)
+        else:
+            transcripts[oid] = lines
+
+    if missing:
+        loaded = message_store.get_messages_for_sessions(db, missing, projection=["role", "content"])
+        for oid, messages in loaded.items():
+            lines = render_messages(messages)
+            transcript_cache.put(str(oid), versions[oid], lines)
+            transcripts[oid] = lines
+
+    return [(oid, transcripts[oid]) for oid in object_ids if oid in transcripts]
+
+
+def build_mention_context(db, session_ids, max_chars=MENTION_CONTEXT_MAX_CHARS, query=None):
+    """History text for the mentioned sessions, trimmed to max_chars.
+
+    If it doesn't fit and a `query` is given, the chunks most relevant to
+    it are retrieved instead (see retrieval.py). Otherwise, or if retrieval
+    fails, the budget is shared evenly between sessions and each keeps its
+    most recent turns; budget a short session doesn't use goes to the others.
+    """
+    loaded = load_transcripts(db, session_ids)
+    total_chars = sum(len(line) for _, lines in loaded for line in lines)
+    if query and retrieval.RETRIEVAL and total_chars > max_chars:
+        try:
+            return retrieval.session_context([(str(oid), lines) for oid, lines in loaded], query, max_chars)
+        except Exception as e:
+            print("Retrieval over mentioned chats failed, using recent turns:", e)
+
+    transcripts = [lines for _, lines in loaded]
+    kept = [None] * len(transcripts)
+    remaining = max_chars
+    # Allocate smallest first so leftover budget flows to the larger sessions
+    order = sorted(range(len(transcripts)), key=lambda i: sum(len(line) for line in transcripts[i]))
+    for n, i in enumerate(order):
+        share = remaining // (len(order) - n)
+        kept[i], used = _take_recent(transcripts[i], share)
+        remaining -= used
+    return "".join(line for lines in kept for line in lines)
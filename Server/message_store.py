@@ -0,0 +1,295 @@
+"""Per-message storage for chat sessions.
+
+Each message is its own document in the `messages` collection, numbered by
+a per-session `seq`. The `sessions` document only keeps metadata
+(name, timestamps, message_count), so appends no longer rewrite an
+ever-growing array and history can be read a page at a time.
+
+Sessions written by older versions still embed a `messages` array. They
+are migrated on their next append, or in bulk with migrate_messages.py.
+"""
+import os
+import threading
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, TEXT
+from pymongo.errors import BulkWriteError
+
+MAX_PAGE_SIZE = 500
+PREVIEW_CHARS = 120
+SUMMARY_FIELDS = {"session_name": 1, "created_at": 1, "updated_at": 1, "message_count": 1, "preview": 1}
+# Stemming language of the search indexes ("none" for plain word matching)
+SEARCH_LANGUAGE = os.getenv("SEARCH_LANGUAGE", "english")
+
+_indexes_ready = False
+_indexes_lock = threading.Lock()
+
+
+def ensure_indexes(db):
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _indexes_lock:
+        if not _indexes_ready:
+            db.messages.create_index([("session_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+            db.sessions.create_index([("updated_at", DESCENDING), ("_id", DESCENDING)])
+            db.sessions.create_index([("created_at", DESCENDING), ("_id", DESCENDING)])
+            # Full-text search (session_search.py); Mongo allows one text index per collection
+            db.messages.create_index(
+                [("content", TEXT)], default_language=SEARCH_LANGUAGE, language_override="search_language"
+            )
+            db.sessions.create_index(
+                [("session_name", TEXT)], default_language=SEARCH_LANGUAGE, language_override="search_language"
+            )
+            _indexes_ready = True
+
+
+def _message_docs(session_oid, messages, first_seq):
+    return [
+        {**m, "session_id": session_oid, "seq": first_seq + i}
+        for i, m in enumerate(messages)
+    ]
+
+
+def _preview(messages):
+    return (messages[-1].get("content") or "")[:PREVIEW_CHARS] if messages else ""
+
+
+def _insert_idempotent(db, docs):
+    """Insert message docs, ignoring ones that already exist (same session/seq)."""
+    if not docs:
+        return
+    try:
+        db.messages.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+
+def migrate_session(db, session_oid):
+    """Move a legacy embedded `messages` array into the messages collection.
+
+    Safe to run concurrently and to re-run after a crash: messages are
+    inserted idempotently first, then the array is dropped only if it is
+    unchanged.
+    """
+    ensure_indexes(db)
+    doc = db.sessions.find_one(
+        {"_id": session_oid, "messages": {"$exists": True}}, {"messages": 1, "created_at": 1}
+    )
+    if not doc:
+        return False
+    legacy = doc.get("messages") or []
+    _insert_idempotent(db, _message_docs(session_oid, legacy, 0))
+    updated_at = (legacy[-1].get("timestamp") if legacy else None) or doc.get("created_at") or datetime.now()
+    update = {
+        "$unset": {"messages": ""},
+        "$set": {"message_count": len(legacy), "preview": _preview(legacy)},
+        "$max": {"updated_at": updated_at},
+    }
+    db.sessions.update_one({"_id": session_oid, "messages": {"$size": len(legacy)}}, update)
+    return True
+
+
+def create_session(db, session_name, messages):
+    """Insert a new session with its first messages. Returns the id as str."""
+    ensure_indexes(db)
+    now = datetime.now()
+    inserted = db.sessions.insert_one({
+        "session_name": session_name,
+        "created_at": now,
+        "updated_at": now,
+        "message_count": len(messages),
+        "preview": _preview(messages),
+    })
+    _insert_idempotent(db, _message_docs(inserted.inserted_id, messages, 0))
+    return str(inserted.inserted_id)
+
+
+def append_messages(db, session_id, messages, set_fields=None):
+    """Append messages to an existing session, reserving seq numbers atomically.
+
+    Returns the seq of the first appended message, or None if the session
+    does not exist.
+    """
+    ensure_indexes(db)
+    session_oid = ObjectId(session_id)
+    migrate_session(db, session_oid)
+    update = {
+        "$inc": {"message_count": len(messages)},
+        "$set": {"updated_at": datetime.now(), "preview": _preview(messages), **(set_fields or {})},
+    }
+    session = db.sessions.find_one_and_update(
+        {"_id": session_oid}, update, projection={"message_count": 1}
+    )
+    if session is None:
+        return None
+    first_seq = session.get("message_count", 0)
+    _insert_idempotent(db, _message_docs(session_oid, messages, first_seq))
+    return first_seq
+
+
+def update_message(db, session_id, message_id, set_fields, unset_fields=None):
+    """Rewrite fields of one stored message by its _id (used for in-progress replies)."""
+    session_oid = ObjectId(session_id)
+    update = {"$set": set_fields}
+    if unset_fields:
+        update["$unset"] = {field: "" for field in unset_fields}
+    db.messages.update_one({"_id": message_id, "session_id": session_oid}, update)
+    session_update = {"updated_at": datetime.now()}
+    if "content" in set_fields:
+        session_update["preview"] = (set_fields["content"] or "")[:PREVIEW_CHARS]
+    db.sessions.update_one({"_id": session_oid}, {"$set": session_update})
+
+
+def delete_message(db, session_id, message_id):
+    """Remove one stored message by its _id (a reply stopped before any of it was shown).
+
+    message_count is left alone: it hands out seq numbers, so it never goes down.
+    """
+    session_oid = ObjectId(session_id)
+    db.messages.delete_one({"_id": message_id, "session_id": session_oid})
+    refresh_preview(db, session_oid)
+
+
+def refresh_preview(db, session_oid):
+    """Reset a session's preview to its last remaining message."""
+    last = db.messages.find_one({"session_id": session_oid}, {"content": 1}, sort=[("seq", DESCENDING)])
+    db.sessions.update_one({"_id": session_oid}, {"$set": {
+        "preview": _preview([last] if last else []), "updated_at": datetime.now(),
+    }})
+
+
+def serialize_message(message):
+    message = dict(message)
+    if "_id" in message:
+        message["id"] = str(message.pop("_id"))
+    message.pop("session_id", None)
+    if isinstance(message.get("timestamp"), datetime):
+        message["timestamp"] = message["timestamp"].isoformat()
+    return message
+
+
+def get_messages(db, session_id, before=None, limit=None):
+    """One page of a session's messages, oldest first.
+
+    Returns (messages, next_before) or None if the session does not exist.
+    `before` is an exclusive seq cursor; without `limit` the whole history
+    is returned. `next_before` is the cursor for the previous page, or None
+    when the start of the session has been reached.
+    """
+    session_oid = ObjectId(session_id)
+    session = db.sessions.find_one({"_id": session_oid}, {"messages": 1})
+    if session is None:
+        return None
+
+    if "messages" in session:
+        legacy = [{**m, "seq": i} for i, m in enumerate(session["messages"])]
+        end = len(legacy) if before is None else max(0, min(before, len(legacy)))
+        start = 0 if limit is None else max(0, end - limit)
+        page = legacy[start:end]
+    else:
+        query = {"session_id": session_oid}
+        if before is not None:
+            query["seq"] = {"$lt": before}
+        cursor = db.messages.find(query).sort("seq", DESCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        page = list(cursor)
+        page.reverse()
+
+    next_before = page[0]["seq"] if page and page[0]["seq"] > 0 else None
+    return [serialize_message(m) for m in page], next_before
+
+
+def get_messages_for_sessions(db, session_oids, projection=None):
+    """Full message lists for several sessions with one query per layout.
+
+    Returns {session ObjectId: [message, ...]} in seq order.
+    """
+    result = {oid: [] for oid in session_oids}
+    if not session_oids:
+        return result
+    legacy_projection = {"messages": 1}
+    if projection:
+        legacy_projection = {f"messages.{field}": 1 for field in projection}
+    for s in db.sessions.find({"_id": {"$in": session_oids}, "messages": {"$exists": True}}, legacy_projection):
+        result[s["_id"]] = s.get("messages", [])
+    migrated = [oid for oid in session_oids if not result[oid]]
+    if migrated:
+        fields = {"session_id": 1, "seq": 1, **{field: 1 for field in projection}} if projection else None
+        cursor = db.messages.find({"session_id": {"$in": migrated}}, fields).sort(
+            [("session_id", ASCENDING), ("seq", ASCENDING)]
+        )
+        for m in cursor:
+            result[m["session_id"]].append(m)
+    return result
+
+
+def _encode_cursor(session, order_by):
+    return f"{session[order_by].isoformat()}_{session['_id']}"
+
+
+def _decode_cursor(cursor):
+    value, oid = cursor.rsplit("_", 1)
+    return datetime.fromisoformat(value), ObjectId(oid)
+
+
+def list_session_summaries(db, session_oids, order_by="updated_at", limit=50, cursor=None):
+    """Lightweight session listing for the sidebar, newest first.
+
+    Only metadata fields are read, never messages. Results are sorted and
+    paged by Mongo on the (order_by, _id) index; `cursor` is the opaque
+    next_cursor of the previous page. Returns (summaries, next_cursor).
+    """
+    ensure_indexes(db)
+    # Legacy sessions have no summary fields until their messages are moved out
+    for legacy in db.sessions.find({"_id": {"$in": session_oids}, "messages": {"$exists": True}}, {"_id": 1}):
+        migrate_session(db, legacy["_id"])
+
+    query = {"_id": {"$in": session_oids}}
+    if cursor:
+        value, last_oid = _decode_cursor(cursor)
+        query["$or"] = [
+            {order_by: {"$lt": value}},
+            {order_by: value, "_id": {"$lt": last_oid}},
+        ]
+    sessions = list(
+        db.sessions.find(query, SUMMARY_FIELDS)
+        .sort([(order_by, DESCENDING), ("_id", DESCENDING)])
+        .limit(limit + 1)
+    )
+    next_cursor = _encode_cursor(sessions[limit - 1], order_by) if len(sessions) > limit else None
+
+    summaries = []
+    for session in sessions[:limit]:
+        summaries.append({
+            "_id": str(session["_id"]),
+            "session_name": session.get("session_name"),
+            "created_at": session["created_at"].isoformat() if session.get("created_at") else None,
+            "updated_at": session["updated_at"].isoformat() if session.get("updated_at") else None,
+            "message_count": session.get("message_count", 0),
+            "preview": session.get("preview", ""),
+        })
+    return summaries, next_cursor
+
+
+def clear_session(db, session_id):
+    """Remove all messages from a session. Returns False if it doesn't exist."""
+    session_oid = ObjectId(session_id)
+    if db.sessions.count_documents({"_id": session_oid}, limit=1) == 0:
+        return False
+    db.messages.delete_many({"session_id": session_oid})
+    db.sessions.update_one(
+        {"_id": session_oid},
+        {"$set": {"message_count": 0, "preview": "", "updated_at": datetime.now()}, "$unset": {"messages": ""}},
+    )
+    return True
+
+
+def delete_session(db, session_id):
+    session_oid = ObjectId(session_id)
+    result = db.sessions.delete_one({"_id": session_oid})
+    db.messages.delete_many({"session_id": session_oid})
+    return result.deleted_count > 0
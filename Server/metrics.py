@@ -0,0 +1,170 @@
+"""Prometheus metrics for the chat hot path, plus per-request timings.
+
+Histograms are exported in Prometheus text format on /metrics. Mongo
+commands are timed by a pymongo command listener, so every query is covered
+without wrapping call sites. A RequestTimings object collects the same
+phases for a single request. A client that sends `timings=1` gets them back
+in the response's JSON or SSE `complete` payload.
+"""
+import threading
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, Gauge, Histogram, generate_latest
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds", "Time until the response (or the start of a stream) is returned",
+    ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS,
+)
+TTFT_SECONDS = Histogram(
+    "generation_time_to_first_token_seconds", "Time from sending a generation to its first chunk",
+    ["model", "backend"], buckets=LATENCY_BUCKETS,
+)
+GENERATION_SECONDS = Histogram(
+    "generation_seconds", "Total time of completed generations",
+    ["model", "backend"], buckets=LATENCY_BUCKETS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "generation_tokens_per_second", "Output tokens per second of completed generations",
+    ["model", "backend"], buckets=RATE_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "ollama_queue_wait_seconds", "Time spent waiting for a free Ollama backend",
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_SECONDS = Histogram(
+    "mongo_command_seconds", "Duration of MongoDB commands",
+    ["command"], buckets=FAST_BUCKETS,
+)
+PDF_EXTRACT_SECONDS = Histogram(
+    "pdf_extraction_seconds", "Time to extract the text of an attached PDF",
+    ["cached"], buckets=LATENCY_BUCKETS,
+)
+
+WRITE_BEHIND_FLUSH_SECONDS = Histogram(
+    "write_behind_flush_seconds", "Time to write one batch of queued chat writes",
+    buckets=FAST_BUCKETS,
+)
+WRITE_BEHIND_QUEUE = Gauge("write_behind_queue_ops", "Chat writes queued and not yet flushed")
+
+
+def export():
+    """Body and content type for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+class RequestTimings:
+    """Seconds spent per phase of one request, reported in milliseconds."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.mongo_commands = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def phase(self, phase):
+        return _Phase(self, phase)
+
+    def stream(self, chunks):
+        """Pass chunks through, recording time to first chunk and total generation time."""
+        start = time.perf_counter()
+        first = True
+        try:
+            for text in chunks:
+                if first:
+                    self.add("ttft", time.perf_counter() - self.start)
+                    first = False
+                yield text
+        finally:
+            self.add("generation", time.perf_counter() - start)
+
+    def as_dict(self):
+        timings = {f"{phase}_ms": round(seconds * 1000, 1) for phase, seconds in self.phases.items()}
+        timings["mongo_commands"] = self.mongo_commands
+        timings["total_ms"] = round((time.perf_counter() - self.start) * 1000, 1)
+        return timings
+
+
+class _Phase:
+    def __init__(self, timings, phase):
+        self.timings = timings
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.phase, time.perf_counter() - self.start)
+
+
+# The RequestTimings Mongo commands on this thread (or greenlet) are added to
+_current = threading.local()
+
+
+def bind(timings):
+    _current.timings = timings
+
+
+def start_request():
+    timings = RequestTimings()
+    bind(timings)
+    return timings
+
+
+def track_generation(chunks, model, backend, stats=None):
+    """Pass chunks through, observing TTFT, duration and tokens/sec.
+
+    `stats` may be filled in by the producer while streaming. Ollama's final
+    message gives eval_count and eval_duration (ns). Without them, tokens/sec
+    is not recorded. Duration and tokens/sec are only recorded for
+    generations that ran to completion.
+    """
+    start = time.perf_counter()
+    first_at = None
+    try:
+        for text in chunks:
+            if first_at is None:
+                first_at = time.perf_counter()
+                TTFT_SECONDS.labels(model, backend).observe(first_at - start)
+            yield text
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    end = time.perf_counter()
+    GENERATION_SECONDS.labels(model, backend).observe(end - start)
+    stats = stats or {}
+    tokens = stats.get("eval_count")
+    if tokens:
+        seconds = stats["eval_duration"] / 1e9 if stats.get("eval_duration") else end - (first_at or start)
+        if seconds > 0:
+            TOKENS_PER_SECOND.labels(model, backend).observe(tokens / seconds)
+
+
+class _MongoListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._observe(event)
+
+    def failed(self, event):
+        self._observe(event)
+
+    def _observe(self, event):
+        seconds = event.duration_micros / 1e6
+        MONGO_SECONDS.labels(event.command_name).observe(seconds)
+        timings = getattr(_current, "timings", None)
+        if timings is not None:
+            timings.add("mongo", seconds)
+            timings.mongo_commands += 1
+
+
+# Must be registered before the MongoClient is created
+monitoring.register(_MongoListener())
@@ -0,0 +1,32 @@
+"""Move messages embedded in `sessions` documents into the `messages` collection.
+
+Sessions are also migrated lazily on their next append, so running this is
+optional; it just avoids carrying large legacy documents around. The script
+is safe to stop and re-run.
+
+    python migrate_messages.py
+"""
+import os
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+
+import message_store
+
+
+def main():
+    load_dotenv()
+    db = MongoClient(os.getenv("MONGODB_URL")).get_default_database()
+    message_store.ensure_indexes(db)
+
+    migrated = 0
+    for session in db.sessions.find({"messages": {"$exists": True}}, {"_id": 1}):
+        if message_store.migrate_session(db, session["_id"]):
+            migrated += 1
+            if migrated % 100 == 0:
+                print(f"Migrated {migrated} sessions...")
+    print(f"Done. Migrated {migrated} sessions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Cached Ollama model catalog with background refresh and model prewarming."""
+import os
+import threading
+import time
+from collections import Counter
+
+import ollama_client
+from ollama_pool import pool
+
+MODEL_CATALOG_TTL = float(os.getenv("MODEL_CATALOG_TTL", "30"))
+MODEL_CATALOG_TIMEOUT = float(os.getenv("MODEL_CATALOG_TIMEOUT", "5"))
+# Comma separated models that should always be kept loaded, e.g. "phi3,llama3"
+MODEL_PREWARM = [m.strip() for m in os.getenv("MODEL_PREWARM", "").split(",") if m.strip()]
+# How many of the most picked models to keep resident (0 disables usage based prewarming)
+MODEL_PREWARM_TOP_N = int(os.getenv("MODEL_PREWARM_TOP_N", "0"))
+MODEL_PREWARM_INTERVAL = float(os.getenv("MODEL_PREWARM_INTERVAL", "120"))
+# Passed to Ollama as keep_alive for prewarmed models, e.g. "30m" or "-1" to never unload
+MODEL_KEEP_ALIVE = os.getenv("MODEL_KEEP_ALIVE", "30m")
+
+
+def _base_name(name):
+    return name.split(":")[0]
+
+
+class ModelCatalog:
+    """Serves the local model list from memory.
+
+    The first call fetches synchronously. After that, entries older than
+    MODEL_CATALOG_TTL are refreshed on a background thread while the stale
+    copy keeps being served, so a busy Ollama never stalls /models.
+    """
+
+    def __init__(self, ttl=MODEL_CATALOG_TTL):
+        self.ttl = ttl
+        self._models = []
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._usage = Counter()
+        self._prewarmer = None
+
+    def get(self):
+        with self._lock:
+            fetched_at = self._fetched_at
+            stale = time.monotonic() - fetched_at > self.ttl
+            start_refresh = stale and fetched_at and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+        if not fetched_at:
+            self.refresh()
+        elif start_refresh:
+            threading.Thread(target=self.refresh, daemon=True).start()
+        self.start_prewarmer()
+        return self._models
+
+    def refresh(self):
+        try:
+            # The union of every healthy backend's models
+            pool.probe_all(timeout=MODEL_CATALOG_TIMEOUT)
+            backends = [b for b in pool.backends if b.healthy and b.tags is not None]
+            if not backends:
+                raise RuntimeError("no Ollama backend is reachable")
+            models = {}
+            for backend in backends:
+                loaded = {m.get("name") for m in backend.running.get("models", [])}
+                for m in backend.tags.get("models", []):
+                    if m["name"] not in models:
+                        details = m.get("details") or {}
+                        models[m["name"]] = {
+                            "name": _base_name(m["name"]),
+                            "tag": m["name"],
+                            "size": m.get("size"),
+                            "parameter_size": details.get("parameter_size"),
+                            "family": details.get("family"),
+                            "modified_at": m.get("modified_at"),
+                            "loaded": False,
+                        }
+                    if m["name"] in loaded:
+                        models[m["name"]]["loaded"] = True
+            with self._lock:
+                self._models = sorted(models.values(), key=lambda m: m["tag"])
+                self._fetched_at = time.monotonic()
+        except Exception as e:
+            print("Model catalog refresh failed:", e)
+            with self._lock:
+                # Back off for a full TTL instead of hammering a struggling backend
+                self._fetched_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def names(self):
+        return sorted(set(m["name"] for m in self.get()))
+
+    def is_loaded(self, model_name):
+        return any(
+            m["loaded"] and (m["name"] == model_name or m["tag"] == model_name)
+            for m in self.get()
+        )
+
+    # ====== Prewarming ======
+
+    def record_use(self, model_name):
+        if not model_name:
+            return
+        with self._lock:
+            self._usage[model_name] += 1
+        self.start_prewarmer()
+
+    def prewarm_targets(self):
+        with self._lock:
+            popular = [m for m, _ in self._usage.most_common(MODEL_PREWARM_TOP_N)] if MODEL_PREWARM_TOP_N else []
+        return list(dict.fromkeys(MODEL_PREWARM + popular))
+
+    def keep_alive_for(self, model_name):
+        """keep_alive to send with a generation, so prewarmed models stay resident."""
+        if model_name in self.prewarm_targets():
+            return MODEL_KEEP_ALIVE
+        return None
+
+    def prewarm(self, model_name):
+        """Load a model into memory (an empty prompt only loads weights)."""
+        backend = pool.route(model_name)
+        if backend is None:
+            return False
+        try:
+            ollama_client.post_json(
+                "/api/generate",
+                {"model": model_name, "keep_alive": MODEL_KEEP_ALIVE},
+                timeout=300,
+                base_url=backend.url,
+            )
+            backend.loaded.add(model_name)
+            return True
+        except Exception as e:
+            print(f"Prewarming {model_name} failed:", e)
+            return False
+
+    def start_prewarmer(self):
+        if not (MODEL_PREWARM or MODEL_PREWARM_TOP_N):
+            return
+        with self._lock:
+            if self._prewarmer is not None:
+                return
+            self._prewarmer = threading.Thread(target=self._prewarm_loop, daemon=True)
+        self._prewarmer.start()
+
+    def _prewarm_loop(self):
+        while True:
+            warmed = False
+            for model_name in self.prewarm_targets():
+                if not self.is_loaded(model_name):
+                    warmed = self.prewarm(model_name) or warmed
+            if warmed:
+                self.refresh()
+            time.sleep(MODEL_PREWARM_INTERVAL)
+
+
+catalog = ModelCatalog()
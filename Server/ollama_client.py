@@ -0,0 +1,185 @@
+"""Shared, connection-pooled HTTP client for Ollama servers.
+
+Calls go to OLLAMA_URL unless a `base_url` is given; ollama_pool picks the
+backend when several are configured.
+"""
+import json
+import os
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434").rstrip("/")
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "100"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.getenv("OLLAMA_READ_TIMEOUT", "60"))
+
+_session = None
+_session_lock = threading.Lock()
+# The _Abort of the streaming request being sent on this thread, if any
+_opening = threading.local()
+
+
+class _Abort:
+    """Shuts down the socket of one streaming request, from any thread.
+
+    Ollama sends no response headers until the first token, so a request
+    that is loading its model or in prefill can only be stopped this way;
+    Ollama cancels the generation once the connection drops.
+    """
+
+    def __init__(self):
+        self.aborted = False
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def attach(self, sock):
+        with self._lock:
+            if not self.aborted:
+                self._sock = sock
+                return
+        _shutdown(sock)
+
+    def detach(self):
+        # The connection goes back to the pool and may carry another request next
+        with self._lock:
+            self._sock = None
+
+    def __call__(self):
+        with self._lock:
+            self.aborted = True
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            _shutdown(sock)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class _AbortableMixin:
+    def request(self, *args, **kwargs):
+        super().request(*args, **kwargs)
+        abort = getattr(_opening, "abort", None)
+        if abort is not None and self.sock is not None:
+            abort.attach(self.sock)
+
+
+class _AbortableHTTPConnection(_AbortableMixin, HTTPConnection):
+    pass
+
+
+class _AbortableHTTPSConnection(_AbortableMixin, HTTPSConnection):
+    pass
+
+
+class _HTTPPool(HTTPConnectionPool):
+    ConnectionCls = _AbortableHTTPConnection
+
+
+class _HTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _AbortableHTTPSConnection
+
+
+class _Adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+
+def get_session():
+    """Return the process-wide keep-alive session, creating it on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = _Adapter(pool_connections=4, pool_maxsize=OLLAMA_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def _timeout(read_timeout=None):
+    return (OLLAMA_CONNECT_TIMEOUT, read_timeout or OLLAMA_READ_TIMEOUT)
+
+
+def get_json(path, timeout=None, base_url=None):
+    res = get_session().get(f"{base_url or OLLAMA_URL}{path}", timeout=_timeout(timeout))
+    res.raise_for_status()
+    return res.json()
+
+
+def post_json(path, payload, timeout=None, base_url=None):
+    res = get_session().post(f"{base_url or OLLAMA_URL}{path}", json=payload, timeout=_timeout(timeout))
+    res.raise_for_status()
+    return res.json()
+
+
+def _stream(path, payload, text_of, timeout, base_url, stats, cancel=None):
+    abort = _Abort()
+    if cancel is not None:
+        cancel.on_cancel(abort)
+    _opening.abort = abort
+    try:
+        response = get_session().post(
+            f"{base_url or OLLAMA_URL}{path}", json=payload, stream=True, timeout=_timeout(timeout)
+        )
+    except requests.RequestException:
+        if abort.aborted:
+            return
+        raise
+    finally:
+        _opening.abort = None
+    try:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if not line:
+                continue
+            try:
+                chunk_data = json.loads(line.decode("utf-8"))
+            except json.JSONDecodeError:
+                continue
+            chunk_text = text_of(chunk_data)
+            if chunk_text:
+                yield chunk_text
+            if chunk_data.get("done", False):
+                if stats is not None:
+                    stats.update(chunk_data)
+                break
+    except requests.RequestException:
+        # A cancelled stream ends quietly; its backend is fine
+        if not abort.aborted:
+            raise
+    finally:
+        abort.detach()
+        response.close()
+
+
+def stream_chat(model, messages, timeout=None, keep_alive=None, base_url=None, stats=None, cancel=None):
+    """Yield reply text chunks from a streaming /api/chat call over `messages`.
+
+    If `stats` is a dict, it is updated with Ollama's final message
+    (eval_count, eval_duration, ...).
+
+    The upstream connection is released back to the pool when the stream
+    finishes, and closed early if the caller closes this generator (e.g. the
+    SSE client disconnected), which cancels the generation on Ollama's side.
+    `cancel` (e.g. a coalesce.Flight) can do the same from another thread
+    through its on_cancel(), even before the first token.
+    """
+    payload = {"model": model, "messages": messages, "stream": True}
+    if keep_alive is not None:
+        payload["keep_alive"] = keep_alive
+    return _stream(
+        "/api/chat", payload, lambda d: (d.get("message") or {}).get("content", ""), timeout, base_url, stats,
+        cancel,
+    )
@@ -0,0 +1,310 @@
+"""Routing of local model generations across a pool of Ollama backends.
+
+Backends come from OLLAMA_BACKENDS (comma separated URLs, defaults to
+OLLAMA_URL) and are probed every OLLAMA_HEALTH_INTERVAL seconds through
+/api/tags and /api/ps. A generation goes to a healthy backend that has the
+model, preferring one where it is already loaded, then the one with the
+fewest outstanding requests. Each backend takes at most
+OLLAMA_BACKEND_MAX_INFLIGHT generations. Extra requests wait in a bounded
+queue that is served round-robin across clients. When the queue is full,
+a request is rejected with PoolBusy right away instead of timing out later.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import requests
+
+import metrics
+import ollama_client
+
+OLLAMA_BACKENDS = [
+    url.strip().rstrip("/")
+    for url in (os.getenv("OLLAMA_BACKENDS") or ollama_client.OLLAMA_URL).split(",")
+    if url.strip()
+]
+OLLAMA_BACKEND_MAX_INFLIGHT = int(os.getenv("OLLAMA_BACKEND_MAX_INFLIGHT", "4"))
+OLLAMA_QUEUE_MAX = int(os.getenv("OLLAMA_QUEUE_MAX", "32"))
+OLLAMA_QUEUE_PER_CLIENT = int(os.getenv("OLLAMA_QUEUE_PER_CLIENT", "4"))
+OLLAMA_QUEUE_TIMEOUT = float(os.getenv("OLLAMA_QUEUE_TIMEOUT", "30"))
+OLLAMA_HEALTH_INTERVAL = float(os.getenv("OLLAMA_HEALTH_INTERVAL", "10"))
+OLLAMA_HEALTH_TIMEOUT = float(os.getenv("OLLAMA_HEALTH_TIMEOUT", "3"))
+# How many sessions' last backend to remember for KV cache affinity
+OLLAMA_AFFINITY_MAX = 10000
+
+
+class PoolBusy(Exception):
+    """No backend can take the request now; the client should retry later."""
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelNotFound(Exception):
+    """No healthy backend has the model; retrying won't help."""
+
+
+def _model_names(models):
+    names = set()
+    for m in models:
+        name = m.get("name") or m.get("model")
+        if name:
+            names.add(name)
+            names.add(name.split(":")[0])
+    return names
+
+
+class Backend:
+    def __init__(self, url):
+        self.url = url
+        # Routable until a probe says otherwise; `probed` tells the two apart
+        self.healthy = True
+        self.probed = False
+        self.outstanding = 0
+        # None until the first probe, which means "might have any model"
+        self.tags = None
+        self.running = {}
+        self.models = None
+        self.loaded = set()
+
+    def has_model(self, model):
+        return self.models is None or model in self.models
+
+    def is_loaded(self, model):
+        return model in self.loaded
+
+    def probe(self, timeout=OLLAMA_HEALTH_TIMEOUT):
+        try:
+            tags = ollama_client.get_json("/api/tags", timeout=timeout, base_url=self.url)
+        except Exception as e:
+            if self.healthy:
+                print(f"Ollama backend {self.url} is unhealthy:", e)
+            self.healthy = False
+            self.probed = True
+            return False
+        try:
+            running = ollama_client.get_json("/api/ps", timeout=timeout, base_url=self.url)
+        except Exception:
+            running = {}
+        self.tags = tags
+        self.running = running
+        self.models = _model_names(tags.get("models", []))
+        self.loaded = _model_names(running.get("models", []))
+        self.healthy = True
+        self.probed = True
+        return True
+
+    def status(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "probed": self.probed,
+            "outstanding": self.outstanding,
+            "loaded": sorted(self.loaded),
+        }
+
+
+class _Waiter:
+    def __init__(self, model, client_id, affinity):
+        self.model = model
+        self.client_id = client_id
+        self.affinity = affinity
+        self.backend = None
+        self.event = threading.Event()
+
+
+class OllamaPool:
+    def __init__(self, urls=OLLAMA_BACKENDS, max_inflight=OLLAMA_BACKEND_MAX_INFLIGHT,
+                 queue_max=OLLAMA_QUEUE_MAX, queue_per_client=OLLAMA_QUEUE_PER_CLIENT,
+                 queue_timeout=OLLAMA_QUEUE_TIMEOUT):
+        self.backends = [Backend(url) for url in urls]
+        self.max_inflight = max_inflight
+        self.queue_max = queue_max
+        self.queue_per_client = queue_per_client
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        # client id -> its waiters, ordered so the least recently served client is first
+        self._queues = OrderedDict()
+        self._waiting = 0
+        # affinity key (session id) -> url of the backend that served it last
+        self._affinity = OrderedDict()
+        self._health_thread = None
+
+    # ====== Health checks ======
+
+    def probe_all(self, timeout=OLLAMA_HEALTH_TIMEOUT):
+        for backend in self.backends:
+            backend.probe(timeout)
+        with self._lock:
+            self._dispatch()
+
+    def start_health_checks(self):
+        with self._lock:
+            if self._health_thread is not None:
+                return
+            self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+        self._health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            self.probe_all()
+            time.sleep(OLLAMA_HEALTH_INTERVAL)
+
+    def mark_unhealthy(self, backend):
+        backend.healthy = False
+        print(f"Ollama backend {backend.url} marked unhealthy")
+
+    # ====== Routing ======
+
+    def _pick(self, model, with_capacity=True, affinity=None):
+        candidates = [
+            b for b in self.backends
+            if b.healthy and b.has_model(model)
+            and (not with_capacity or b.outstanding < self.max_inflight)
+        ]
+        if not candidates:
+            return None
+        preferred = self._affinity.get(affinity) if affinity else None
+        return min(candidates, key=lambda b: (b.url != preferred, not b.is_loaded(model), b.outstanding))
+
+    def route(self, model):
+        """Backend a request for `model` would go to, ignoring capacity."""
+        with self._lock:
+            return self._pick(model, with_capacity=False)
+
+    def _check_admission(self, model, client_id):
+        if self._pick(model, with_capacity=False) is None:
+            if not any(b.healthy for b in self.backends):
+                raise PoolBusy("No Ollama backend is reachable right now", OLLAMA_HEALTH_INTERVAL)
+            raise ModelNotFound(f"No healthy Ollama backend has model '{model}'")
+        if self._pick(model) is not None:
+            return
+        if self._waiting >= self.queue_max:
+            raise PoolBusy("All Ollama backends are busy, please retry shortly")
+        if len(self._queues.get(client_id, ())) >= self.queue_per_client:
+            raise PoolBusy("Too many of your requests are already waiting, please retry shortly")
+
+    def check_admission(self, model, client_id=None):
+        """Raise PoolBusy or ModelNotFound now if acquire() would, without taking a slot."""
+        self.start_health_checks()
+        with self._lock:
+            self._check_admission(model, client_id)
+
+    def acquire(self, model, client_id=None, affinity=None, cancel=None):
+        """Reserve a backend for one generation, waiting in the queue if needed.
+
+        If `cancel` is cancelled while waiting, the wait ends at once with
+        PoolBusy and the queue slot goes to the next request.
+        """
+        self.start_health_checks()
+        with self._lock:
+            self._check_admission(model, client_id)
+            backend = self._pick(model, affinity=affinity)
+            if backend is not None:
+                return self._take(backend, model, affinity)
+            waiter = _Waiter(model, client_id, affinity)
+            self._queues.setdefault(client_id, deque()).append(waiter)
+            self._waiting += 1
+
+        if cancel is not None:
+            cancel.on_cancel(waiter.event.set)
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            if waiter.backend is None:
+                self._queues[client_id].remove(waiter)
+                if not self._queues[client_id]:
+                    del self._queues[client_id]
+                self._waiting -= 1
+                if cancel is not None and cancel.cancelled:
+                    raise PoolBusy("Cancelled while waiting for an Ollama backend")
+                raise PoolBusy("Timed out waiting for an Ollama backend")
+        return waiter.backend
+
+    def release(self, backend):
+        with self._lock:
+            backend.outstanding -= 1
+            self._dispatch()
+
+    def _take(self, backend, model, affinity=None):
+        backend.outstanding += 1
+        # Ollama loads the model on first use, so route its next requests here too
+        backend.loaded.add(model)
+        if affinity:
+            self._affinity[affinity] = backend.url
+            self._affinity.move_to_end(affinity)
+            if len(self._affinity) > OLLAMA_AFFINITY_MAX:
+                self._affinity.popitem(last=False)
+        return backend
+
+    def _dispatch(self):
+        """Hand free slots to waiters, one per client in turn."""
+        while self._waiting:
+            for client_id, queue in self._queues.items():
+                backend = self._pick(queue[0].model, affinity=queue[0].affinity)
+                if backend is not None:
+                    break
+            else:
+                return
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(client_id)
+            else:
+                del self._queues[client_id]
+            self._waiting -= 1
+            waiter.backend = self._take(backend, waiter.model, waiter.affinity)
+            waiter.event.set()
+
+    def status(self):
+        with self._lock:
+            return {
+                "backends": [b.status() for b in self.backends],
+                "waiting": self._waiting,
+            }
+
+
+pool = OllamaPool()
+
+
+def _leased_stream(model, client_id, timings, affinity, cancel, open_stream):
+    """Run open_stream(base_url, stats) on a backend leased from the pool.
+
+    The lease is taken when iteration starts and returned when the stream
+    ends or is closed. The wait for it is added to `timings` if given.
+    """
+    wait_start = time.perf_counter()
+    backend = pool.acquire(model, client_id, affinity, cancel)
+    waited = time.perf_counter() - wait_start
+    metrics.QUEUE_WAIT_SECONDS.observe(waited)
+    if timings is not None:
+        timings.add("queue_wait", waited)
+    try:
+        if cancel is not None and cancel.cancelled:
+            return
+        stats = {}
+        chunks = open_stream(backend.url, stats)
+        yield from metrics.track_generation(chunks, model, backend.url, stats)
+    except requests.ConnectionError:
+        pool.mark_unhealthy(backend)
+        raise
+    finally:
+        pool.release(backend)
+
+
+def stream_chat(model, messages, client_id=None, timeout=None, keep_alive=None, timings=None, affinity=None,
+                cancel=None):
+    """ollama_client.stream_chat on a pooled backend.
+
+    Requests with the same `affinity` key (a session id) go back to the
+    backend that served the previous one when it has room, since that
+    backend still holds the conversation's KV cache. Once `cancel` (a
+    coalesce.Flight) is cancelled, the request leaves the queue or drops
+    its connection right away instead of at the next token.
+    """
+    return _leased_stream(
+        model, client_id, timings, affinity, cancel,
+        lambda base_url, stats: ollama_client.stream_chat(
+            model, messages, timeout=timeout, keep_alive=keep_alive, base_url=base_url, stats=stats, cancel=cancel
+        ),
+    )
@@ -0,0 +1,164 @@
+"""PDF text extraction: page ranges in a process pool, cached by content hash."""
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "300"))
+PDF_MAX_CHARS = int(os.getenv("PDF_MAX_CHARS", "400000"))
+# 0 extracts in the request thread only
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Smaller documents aren't worth the round trip to the pool
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "16"))
+PDF_CACHE_MAX_CHARS = int(os.getenv("PDF_CACHE_MAX_CHARS", "20000000"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn: don't fork the server's threads, sockets or Mongo client
+                _pool = ProcessPoolExecutor(
+                    max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn")
+                )
+    return _pool
+
+
+def _extract_range(path, start, end):
+    """Runs in a worker process: text of pages [start, end)."""
+    import fitz
+
+    with fitz.open(path) as doc:
+        return [doc[i].get_text() for i in range(start, end)]
+
+
+class TextCache:
+    """LRU of extracted page lists keyed by sha256, bounded by total characters."""
+
+    def __init__(self, max_chars=PDF_CACHE_MAX_CHARS):
+        self.max_chars = max_chars
+        self._entries = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            pages = self._entries.get(key)
+            if pages is not None:
+                self._entries.move_to_end(key)
+            return pages
+
+    def put(self, key, pages):
+        size = sum(len(p) for p in pages)
+        if size > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = pages
+            self._chars += size
+            while self._chars > self.max_chars:
+                _, evicted = self._entries.popitem(last=False)
+                self._chars -= sum(len(p) for p in evicted)
+
+
+text_cache = TextCache()
+
+
+def content_hash(file_bytes):
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def _open(source):
+    # PyMuPDF is imported on the first PDF, not when the server starts
+    import fitz
+
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def _iter_extracted_pages(source):
+    with _open(source) as doc:
+        total = doc.page_count
+        pages = min(total, PDF_MAX_PAGES)
+        if PDF_WORKERS <= 0 or pages < PDF_PARALLEL_MIN_PAGES:
+            for i in range(pages):
+                yield doc[i].get_text()
+            if total > pages:
+                yield f"[Only the first {pages} of {total} pages were extracted]"
+            return
+
+    # Workers open the document from a file instead of each receiving a copy of the bytes
+    tmp_path = None
+    path = source
+    if isinstance(source, (bytes, bytearray)):
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+            tmp.write(source)
+        path = tmp_path = tmp.name
+    try:
+        step = -(-pages // PDF_WORKERS)
+        futures = [
+            _get_pool().submit(_extract_range, path, start, min(start + step, pages))
+            for start in range(0, pages, step)
+        ]
+        # Hand pages on in order as soon as each range is done
+        for future in futures:
+            yield from future.result()
+        if total > pages:
+            yield f"[Only the first {pages} of {total} pages were extracted]"
+    finally:
+        if tmp_path:
+            os.unlink(tmp_path)
+
+
+def iter_text(source, key=None):
+    """Yield the document's text piece by piece, capped at PDF_MAX_CHARS.
+
+    `source` is the PDF's bytes or a path to it; `key` is its sha256 if the
+    caller already knows it. Callers join the pieces straight into the
+    prompt, so the full text is never built up by repeated concatenation.
+    """
+    if key is None:
+        if not isinstance(source, (bytes, bytearray)):
+            with open(source, "rb") as f:
+                source = f.read()
+        key = content_hash(source)
+    start = time.perf_counter()
+    pages = text_cache.get(key)
+    if pages is not None:
+        metrics.PDF_EXTRACT_SECONDS.labels("true").observe(time.perf_counter() - start)
+        yield from pages
+        return
+
+    pages = []
+    remaining = PDF_MAX_CHARS
+    extracted = _iter_extracted_pages(source)
+    try:
+        for text in extracted:
+            if len(text) + 2 > remaining:
+                pages.append(text[:remaining])
+                pages.append(f"\n\n[Truncated at {PDF_MAX_CHARS} characters]")
+                yield from pages[-2:]
+                break
+            pages.append(text + "\n\n")
+            remaining -= len(text) + 2
+            yield pages[-1]
+    finally:
+        extracted.close()
+    metrics.PDF_EXTRACT_SECONDS.labels("false").observe(time.perf_counter() - start)
+    text_cache.put(key, tuple(pages))
+
+
+def extract_text(source, key=None):
+    return "".join(iter_text(source, key)).strip()
@@ -0,0 +1,105 @@
+"""Exact-match cache of model replies.
+
+Keyed on the model, the normalized prompt and the attachment hash. Entries
+live in an in-memory LRU and, optionally, in a Mongo collection with a TTL
+index so they survive restarts and are shared between workers.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+# Seconds a reply is kept in Mongo; 0 keeps the cache in memory only
+RESPONSE_CACHE_MONGO_TTL = int(os.getenv("RESPONSE_CACHE_MONGO_TTL", "0"))
+# Size of the pieces a cached reply is replayed in over SSE
+REPLAY_CHUNK_CHARS = 64
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt):
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", prompt)).strip()
+
+
+def make_key(model_type, model_name, prompt, attachment_sha256=None, history=None):
+    """`history` is the earlier conversation sent along with the prompt, if any."""
+    parts = [model_type, model_name, normalize_prompt(prompt), attachment_sha256]
+    if history:
+        parts.append(history)
+    raw = json.dumps(parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES, mongo_ttl=RESPONSE_CACHE_MONGO_TTL):
+        self.max_entries = max_entries
+        self.mongo_ttl = mongo_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._index_ready = False
+
+    def _ensure_index(self, db):
+        if not self._index_ready:
+            db.response_cache.create_index("created_at", expireAfterSeconds=self.mongo_ttl)
+            self._index_ready = True
+
+    def _remember(self, key, reply):
+        with self._lock:
+            self._entries[key] = reply
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, db, key):
+        with self._lock:
+            reply = self._entries.get(key)
+            if reply is not None:
+                self._entries.move_to_end(key)
+                return reply
+        if self.mongo_ttl > 0:
+            try:
+                doc = db.response_cache.find_one({"_id": key}, {"reply": 1})
+            except Exception as e:
+                print("Response cache lookup failed:", e)
+                return None
+            if doc:
+                self._remember(key, doc["reply"])
+                return doc["reply"]
+        return None
+
+    def set(self, db, key, reply, model_name=None):
+        self._remember(key, reply)
+        if self.mongo_ttl > 0:
+            try:
+                self._ensure_index(db)
+                db.response_cache.update_one(
+                    {"_id": key},
+                    {"$set": {"reply": reply, "model_name": model_name, "created_at": datetime.now(timezone.utc)}},
+                    upsert=True,
+                )
+            except Exception as e:
+                print("Response cache write failed:", e)
+
+
+cache = ResponseCache()
+
+
+def lookup(db, key):
+    return cache.get(db, key) if RESPONSE_CACHE else None
+
+
+def store(db, key, reply, model_name=None):
+    if RESPONSE_CACHE and reply:
+        cache.set(db, key, reply, model_name)
+
+
+def replay_chunks(reply):
+    """Split a cached reply into stream-sized pieces."""
+    for i in range(0, len(reply), REPLAY_CHUNK_CHARS):
+        yield reply[i:i + REPLAY_CHUNK_CHARS]
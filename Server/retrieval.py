@@ -0,0 +1,257 @@
+"""Top-k retrieval over mentioned sessions and attached PDFs.
+
+When a mentioned session or a PDF is too long to paste whole, its text is
+split into chunks. Each chunk is embedded with a local Ollama embedding
+model and only the chunks closest to the user's message go into the prompt.
+
+Each source has its own VectorIndex, a float32 NumPy matrix of normalized
+vectors that grows in place. Session indexes are kept up to date
+incrementally. On each use, only messages that are new (or changed, like
+a reply that was still streaming) since the last sync are embedded. PDFs
+are indexed once per content hash. Indexes live in an LRU bounded by
+RETRIEVAL_INDEX_MAX_BYTES.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import requests
+
+import ollama_client
+from ollama_pool import pool
+
+# Off by default: it needs RETRIEVAL_EMBED_MODEL pulled in Ollama
+RETRIEVAL = os.getenv("RETRIEVAL", "0") == "1"
+RETRIEVAL_EMBED_MODEL = os.getenv("RETRIEVAL_EMBED_MODEL", "nomic-embed-text")
+RETRIEVAL_CHUNK_CHARS = int(os.getenv("RETRIEVAL_CHUNK_CHARS", "1000"))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "150"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+# PDFs longer than this are searched instead of pasted whole
+RETRIEVAL_PDF_MIN_CHARS = int(os.getenv("RETRIEVAL_PDF_MIN_CHARS", "12000"))
+RETRIEVAL_INDEX_MAX_BYTES = int(os.getenv("RETRIEVAL_INDEX_MAX_BYTES", str(256 * 1024 * 1024)))
+EMBED_BATCH_SIZE = 64
+EMBED_TIMEOUT = 120
+
+
+def embed(texts):
+    """Normalized float32 embeddings, one row per text."""
+    # NumPy is imported on the first retrieval, not when the server starts
+    import numpy as np
+
+    rows = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        # Each batch takes a pool slot like a generation does, so embedding
+        # counts against OLLAMA_BACKEND_MAX_INFLIGHT and waits in the queue
+        backend = pool.acquire(RETRIEVAL_EMBED_MODEL)
+        try:
+            res = ollama_client.post_json(
+                "/api/embed",
+                {"model": RETRIEVAL_EMBED_MODEL, "input": texts[i:i + EMBED_BATCH_SIZE]},
+                timeout=EMBED_TIMEOUT,
+                base_url=backend.url,
+            )
+        except requests.ConnectionError:
+            pool.mark_unhealthy(backend)
+            raise
+        finally:
+            pool.release(backend)
+        rows.extend(res["embeddings"])
+    vectors = np.asarray(rows, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def split_text(text, size=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    """Pieces of about `size` characters overlapping by `overlap`, cut at whitespace where possible."""
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            cut = text.rfind(" ", start + size // 2, end)
+            if cut > start:
+                end = cut
+        pieces.append(text[start:end])
+        if end == len(text):
+            break
+        next_start = max(start + 1, end - overlap)
+        # Begin the next piece on a word boundary too
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return pieces
+
+
+class VectorIndex:
+    """Chunks of one source and their embeddings.
+
+    Each chunk records the span of source lines it came from, so the index
+    can be cut back to the lines that are unchanged and extended from there.
+    """
+
+    def __init__(self):
+        self.vectors = None
+        self.size = 0
+        self.texts = []
+        self.spans = []
+        self.line_hashes = []
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        vector_bytes = self.vectors.nbytes if self.vectors is not None else 0
+        return vector_bytes + sum(len(t) for t in self.texts)
+
+    def _append(self, vectors, texts, spans):
+        import numpy as np
+
+        needed = self.size + len(vectors)
+        if self.vectors is None:
+            self.vectors = np.empty((max(needed, 16), vectors.shape[1]), dtype=np.float32)
+        elif needed > len(self.vectors):
+            grown = np.empty((max(needed, 2 * len(self.vectors)), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+        self.vectors[self.size:needed] = vectors
+        self.size = needed
+        self.texts.extend(texts)
+        self.spans.extend(spans)
+
+    def _truncate_lines(self, line_count):
+        """Drop chunks that touch lines from `line_count` on."""
+        keep = 0
+        while keep < self.size and self.spans[keep][1] < line_count:
+            keep += 1
+        self.size = keep
+        del self.texts[keep:]
+        del self.spans[keep:]
+        # Lines after the last kept chunk have to be chunked again
+        indexed_lines = self.spans[keep - 1][1] + 1 if keep else 0
+        del self.line_hashes[indexed_lines:]
+        return indexed_lines
+
+    def sync_lines(self, lines):
+        """Bring the index in line with `lines`, embedding only what changed."""
+        hashes = [hashlib.sha1(line.encode("utf-8")).digest() for line in lines]
+        with self.lock:
+            unchanged = 0
+            limit = min(len(hashes), len(self.line_hashes))
+            while unchanged < limit and hashes[unchanged] == self.line_hashes[unchanged]:
+                unchanged += 1
+            if unchanged == len(hashes) == len(self.line_hashes):
+                return
+            start = self._truncate_lines(unchanged)
+
+            texts, spans = [], []
+            group, group_start, group_len = [], start, 0
+            for i in range(start, len(lines)):
+                line = lines[i]
+                if len(line) > RETRIEVAL_CHUNK_CHARS:
+                    if group:
+                        texts.append("".join(group))
+                        spans.append((group_start, i - 1))
+                        group, group_len = [], 0
+                    for piece in split_text(line):
+                        texts.append(piece)
+                        spans.append((i, i))
+                    group_start = i + 1
+                    continue
+                if group and group_len + len(line) > RETRIEVAL_CHUNK_CHARS:
+                    texts.append("".join(group))
+                    spans.append((group_start, i - 1))
+                    group, group_len = [], 0
+                if not group:
+                    group_start = i
+                group.append(line)
+                group_len += len(line)
+            if group:
+                texts.append("".join(group))
+                spans.append((group_start, len(lines) - 1))
+
+            if texts:
+                self._append(embed(texts), texts, spans)
+            self.line_hashes = hashes
+
+    def search(self, query_vector, k):
+        """[(score, chunk index)] of the k closest chunks."""
+        import numpy as np
+
+        with self.lock:
+            if not self.size:
+                return []
+            scores = self.vectors[:self.size] @ query_vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [(float(scores[i]), int(i)) for i in top]
+
+
+class IndexCache:
+    def __init__(self, max_bytes=RETRIEVAL_INDEX_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            index = self._indexes.get(key)
+            if index is None:
+                index = self._indexes[key] = VectorIndex()
+            self._indexes.move_to_end(key)
+            return index
+
+    def trim(self):
+        with self._lock:
+            total = sum(index.nbytes for index in self._indexes.values())
+            while total > self.max_bytes and len(self._indexes) > 1:
+                _, evicted = self._indexes.popitem(last=False)
+                total -= evicted.nbytes
+
+
+indexes = IndexCache()
+
+
+def _top_chunks(sources, query, max_chars):
+    """Best chunks across `sources` [(index, label)], grouped by source in document order."""
+    query_vector = embed([query])[0]
+    hits = []
+    for n, (index, _) in enumerate(sources):
+        hits.extend((score, n, i) for score, i in index.search(query_vector, RETRIEVAL_TOP_K))
+    hits.sort(reverse=True)
+
+    chosen = []
+    used = 0
+    for score, n, i in hits[:RETRIEVAL_TOP_K]:
+        text = sources[n][0].texts[i]
+        if used + len(text) > max_chars:
+            continue
+        chosen.append((n, i))
+        used += len(text)
+    indexes.trim()
+
+    blocks = []
+    for n, (index, label) in enumerate(sources):
+        picked = sorted(i for m, i in chosen if m == n)
+        if picked:
+            excerpts = "\n...\n".join(index.texts[i].strip() for i in picked)
+            blocks.append(f"{label}\n{excerpts}\n" if label else f"{excerpts}\n")
+    return "\n".join(blocks)
+
+
+def session_context(transcripts, query, max_chars):
+    """Relevant excerpts of the mentioned sessions. `transcripts` is [(session id, lines)]."""
+    sources = []
+    for n, (session_id, lines) in enumerate(transcripts):
+        index = indexes.get(("session", session_id))
+        index.sync_lines(lines)
+        sources.append((index, f"[Excerpts from mentioned chat {n + 1}]" if len(transcripts) > 1 else ""))
+    return _top_chunks(sources, query, max_chars)
+
+
+def pdf_context(sha256, text, query, max_chars):
+    """Relevant excerpts of a PDF's extracted text."""
+    index = indexes.get(("pdf", sha256))
+    with index.lock:
+        needs_index = not index.size
+    if needs_index:
+        index.sync_lines(split_text(text))
+    return _top_chunks([(index, "")], query, max_chars)
@@ -0,0 +1,38 @@
+"""Cooperative (gevent) server entry point.
+
+`python app.py` runs Flask's development server, which holds one OS thread
+per open request. Long token streams pin a thread each, so a single process
+tops out at a few dozen concurrent chats. Running through gevent turns every
+request into a greenlet instead: socket reads on Ollama, MongoDB and the
+client all yield to the event loop, so one process can keep hundreds of SSE
+streams open.
+
+    python serve.py
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+try:
+    # Gemini talks gRPC; make its blocking calls cooperative too
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+except Exception:
+    pass
+
+import os
+import signal
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+from app import create_app
+
+if __name__ == "__main__":
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "5000"))
+    print(f"Serving on http://{host}:{port} (gevent)")
+    server = WSGIServer((host, port), create_app())
+    # Stop cleanly on SIGTERM so exit hooks (the write-behind flush) run
+    gevent.signal_handler(signal.SIGTERM, server.stop)
+    server.serve_forever()
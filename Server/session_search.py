@@ -0,0 +1,127 @@
+"""Full-text search over a client's sessions.
+
+Searches go through MongoDB text indexes on `messages.content` and
+`sessions.session_name` (created in message_store.ensure_indexes), so a
+query only reads the index entries for its terms instead of scanning every
+message. Hits are ranked by Mongo's textScore and paged with an offset.
+"""
+import os
+import re
+
+from pymongo import DESCENDING
+
+import message_store
+
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", "50"))
+SNIPPET_CHARS = 160
+SESSION_HITS_MAX = 10
+
+_SCORE = {"score": {"$meta": "textScore"}}
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def _terms(query):
+    """Words of `query` that should be highlighted (negated terms are skipped)."""
+    terms = []
+    for token in query.split():
+        if token.startswith("-"):
+            continue
+        terms.extend(w.lower() for w in _WORD.findall(token))
+    return terms
+
+
+def snippet(text, terms, width=SNIPPET_CHARS):
+    """A window of `text` around the first term that occurs in it.
+
+    Mongo matches stemmed words, so when no term appears verbatim the
+    window is centred on the term's stem-length prefix instead.
+    """
+    text = " ".join(text.split())
+    lower = text.lower()
+    position = -1
+    for term in terms:
+        for needle in (term, term[:max(3, len(term) - 2)]):
+            position = lower.find(needle)
+            if position != -1:
+                break
+        if position != -1:
+            break
+    if len(text) <= width:
+        return text
+    if position == -1:
+        return text[:width].rstrip() + "…"
+
+    start = max(0, position - width // 3)
+    end = min(len(text), start + width)
+    start = max(0, end - width)
+    # Don't cut words in half at either edge
+    if start > 0:
+        space = text.find(" ", start, position)
+        start = space + 1 if space != -1 else start
+    if end < len(text):
+        space = text.rfind(" ", position, end)
+        end = space if space > position else end
+    return ("…" if start > 0 else "") + text[start:end] + ("…" if end < len(text) else "")
+
+
+def search(db, session_oids, query, limit=20, offset=0):
+    """Ranked hits for `query` within `session_oids`.
+
+    Returns (session_hits, message_hits, next_offset). Session name matches
+    are only returned with the first page; message hits are paged by
+    `offset`, and next_offset is None on the last page.
+    """
+    message_store.ensure_indexes(db)
+    # Legacy sessions keep messages embedded, out of reach of the index
+    for legacy in db.sessions.find({"_id": {"$in": session_oids}, "messages": {"$exists": True}}, {"_id": 1}):
+        message_store.migrate_session(db, legacy["_id"])
+
+    terms = _terms(query)
+    names = {}
+    session_hits = []
+    if offset == 0:
+        cursor = (
+            db.sessions.find({"$text": {"$search": query}, "_id": {"$in": session_oids}},
+                             {"session_name": 1, "updated_at": 1, **_SCORE})
+            .sort([("score", _SCORE["score"]), ("_id", DESCENDING)])
+            .limit(SESSION_HITS_MAX)
+        )
+        for session in cursor:
+            names[session["_id"]] = session.get("session_name")
+            session_hits.append({
+                "session_id": str(session["_id"]),
+                "session_name": session.get("session_name"),
+                "updated_at": session["updated_at"].isoformat() if session.get("updated_at") else None,
+                "score": round(session["score"], 4),
+            })
+
+    messages = list(
+        db.messages.find(
+            {"$text": {"$search": query}, "session_id": {"$in": session_oids}},
+            {"session_id": 1, "seq": 1, "role": 1, "content": 1, "timestamp": 1, **_SCORE},
+        )
+        .sort([("score", _SCORE["score"]), ("_id", DESCENDING)])
+        .skip(offset)
+        .limit(limit + 1)
+    )
+    next_offset = offset + limit if len(messages) > limit else None
+    messages = messages[:limit]
+
+    missing = list({m["session_id"] for m in messages} - names.keys())
+    if missing:
+        for session in db.sessions.find({"_id": {"$in": missing}}, {"session_name": 1}):
+            names[session["_id"]] = session.get("session_name")
+
+    message_hits = []
+    for m in messages:
+        timestamp = m.get("timestamp")
+        message_hits.append({
+            "session_id": str(m["session_id"]),
+            "session_name": names.get(m["session_id"]),
+            "seq": m["seq"],
+            "role": m.get("role"),
+            "timestamp": timestamp.isoformat() if hasattr(timestamp, "isoformat") else timestamp,
+            "snippet": snippet(m.get("content") or "", terms),
+            "score": round(m["score"], 4),
+        })
+    return session_hits, message_hits, next_offset
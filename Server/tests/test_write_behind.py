@@ -0,0 +1,108 @@
+"""Write-behind retries and spill replay, against mongomock."""
+import pytest
+from bson import ObjectId
+
+mongomock = pytest.importorskip("mongomock")
+
+import message_store
+import write_behind
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["test"]
+
+
+def _writer():
+    writer = write_behind.WriteBehind()
+    writer._ensure_started = lambda db: None
+    return writer
+
+
+def _create_op(*contents):
+    writer = _writer()
+    session_id = writer.create_session(None, "s", [{"role": "user", "content": c} for c in contents])
+    return session_id, writer._ops.popleft()
+
+
+def _append_op(session_id, *contents):
+    writer = _writer()
+    writer.append_messages(None, session_id, [{"role": "user", "content": c} for c in contents])
+    return writer._ops.popleft()
+
+
+def _fail_first_insert(monkeypatch):
+    insert = message_store._insert_idempotent
+    calls = []
+
+    def fail_once(db, docs):
+        calls.append(len(docs))
+        if len(calls) == 1:
+            raise RuntimeError("transient")
+        insert(db, docs)
+
+    monkeypatch.setattr(message_store, "_insert_idempotent", fail_once)
+
+
+def _stored(db, session_id):
+    session = db.sessions.find_one({"_id": ObjectId(session_id)})
+    seqs = [m["seq"] for m in db.messages.find({"session_id": session["_id"]}).sort("seq", 1)]
+    return session["message_count"], seqs
+
+
+def test_retried_append_reuses_reserved_seqs(db, monkeypatch):
+    session_id = message_store.create_session(db, "s", [{"role": "user", "content": "first"}])
+    op = _append_op(session_id, "second", "third")
+
+    _fail_first_insert(monkeypatch)
+    with pytest.raises(RuntimeError):
+        write_behind._write_batch(db, [op])
+    write_behind._write_batch(db, [op])
+
+    assert _stored(db, session_id) == (3, [0, 1, 2])
+
+
+def test_retried_create_counts_appends_queued_meanwhile(db, monkeypatch):
+    session_id, create = _create_op("u0", "b0")
+    append = _append_op(session_id, "u1", "b1")
+
+    # The session is stored, then inserting its messages fails; the retry
+    # also picks up an append queued meanwhile
+    _fail_first_insert(monkeypatch)
+    with pytest.raises(RuntimeError):
+        write_behind._write_batch(db, [create])
+    write_behind._write_batch(db, [create, append])
+    write_behind._write_batch(db, [_append_op(session_id, "u2", "b2")])
+
+    assert _stored(db, session_id) == (6, [0, 1, 2, 3, 4, 5])
+    contents = [m["content"] for m in db.messages.find({"session_id": ObjectId(session_id)}).sort("seq", 1)]
+    assert contents == ["u0", "b0", "u1", "b1", "u2", "b2"]
+
+
+def test_spilled_append_replays_once(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_SPILL_PATH", str(tmp_path / "spill.jsonl"))
+    session_id = message_store.create_session(db, "s", [{"role": "user", "content": "first"}])
+    op = _append_op(session_id, "second")
+    # Written, then spilled as in flight when shutdown timed out
+    write_behind._write_batch(db, [op])
+    write_behind.WriteBehind()._spill([op])
+
+    first, second = write_behind.WriteBehind(), write_behind.WriteBehind()
+    replayed = first._load_spill()
+    assert second._load_spill() == []
+    write_behind._write_batch(db, replayed)
+
+    assert _stored(db, session_id) == (2, [0, 1])
+    assert not list(tmp_path.iterdir())
+
+
+def test_delete_in_same_batch_as_insert(db):
+    writer = _writer()
+    session_id = writer.create_session(None, "s", [{"role": "user", "content": "q"}])
+    bot_id = ObjectId()
+    writer.append_messages(None, session_id, [{"_id": bot_id, "role": "bot", "content": "partial"}])
+    writer.delete_message(None, session_id, bot_id)
+    write_behind._write_batch(db, list(writer._ops))
+
+    assert _stored(db, session_id) == (2, [0])
+    assert db.sessions.find_one({"_id": ObjectId(session_id)})["preview"] == "q"
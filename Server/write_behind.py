@@ -0,0 +1,396 @@
+"""Optional write-behind persistence for chat turns.
+
+With WRITE_BEHIND=1, new sessions, message appends and in-progress reply
+updates are queued instead of written in the request path. A background
+worker drains the queue every WRITE_BEHIND_FLUSH_MS milliseconds. Each
+batch is written with unordered bulk operations:
+
+- new sessions go in one insert_many;
+- each appended-to session needs one find_one_and_update, which reserves
+  its seq numbers;
+- all new messages go in one insert_many;
+- updates to messages already stored go in one bulk_write;
+- deleted messages go in one delete_many.
+
+Updates to a message still in the batch are folded into its insert.
+
+Guarantees:
+  * Order: writes for one session are applied in the order they were
+    queued. A failed batch is retried from the front of the queue.
+    Retries are idempotent: messages get their _id when queued, and an
+    append remembers the seq numbers it reserved (`first_seq`), so a
+    retry or replay reuses them instead of reserving more.
+  * Read-your-writes: readers call wait_for() with the sessions they are
+    about to read. It flushes those sessions' pending writes first. It
+    also starts the worker, and replays any spill, if this process hasn't
+    yet.
+  * Back-pressure: at most WRITE_BEHIND_QUEUE_MAX operations are queued.
+    When Mongo falls behind, callers wait up to WRITE_BEHIND_FULL_WAIT
+    seconds for room. After that they get WriterBusy, answered as a 503
+    with Retry-After.
+  * Shutdown: at interpreter exit, the queue is flushed for up to
+    WRITE_BEHIND_SHUTDOWN_TIMEOUT seconds. Whatever could not be written
+    is spilled to WRITE_BEHIND_SPILL_PATH. The next process to start its
+    worker claims the file by renaming it, then replays it.
+
+The queue is per process, so reads through another worker process only
+see a session's writes once they are flushed. Route a session's requests
+to one process, as resumable streams already require.
+
+With WRITE_BEHIND=0 (the default), every function here writes through to
+message_store, as before.
+"""
+import atexit
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+
+from bson import ObjectId, json_util
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import message_store
+import metrics
+
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_FLUSH_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", "50"))
+WRITE_BEHIND_BATCH_MAX = int(os.getenv("WRITE_BEHIND_BATCH_MAX", "500"))
+WRITE_BEHIND_QUEUE_MAX = int(os.getenv("WRITE_BEHIND_QUEUE_MAX", "5000"))
+WRITE_BEHIND_FULL_WAIT = float(os.getenv("WRITE_BEHIND_FULL_WAIT", "5"))
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.getenv("WRITE_BEHIND_SHUTDOWN_TIMEOUT", "10"))
+WRITE_BEHIND_SPILL_PATH = os.getenv("WRITE_BEHIND_SPILL_PATH", "write_behind_spill.jsonl")
+# How long wait_for() holds a read for pending writes before reading anyway
+READ_WAIT_SECONDS = 5
+RETRY_BACKOFF_MAX = 5
+# Naive datetimes are written as UTC; read them back naive so they round-trip unchanged
+SPILL_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+class WriterBusy(Exception):
+    """The write queue stayed full; the client should retry later."""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class WriteBehind:
+    def __init__(self):
+        self._ops = deque()
+        self._pending = Counter()
+        self._cond = threading.Condition()
+        self._db = None
+        self._worker = None
+        self._urgent = False
+        self._closing = False
+        self._inflight = []
+
+    def _ensure_started(self, db):
+        """Start the worker on first use, replaying writes spilled by the last shutdown."""
+        if self._worker is not None:
+            return
+        self._db = db
+        self._ops.extendleft(reversed(self._load_spill()))
+        for op in self._ops:
+            self._pending[str(op["session_id"])] += 1
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def _enqueue(self, db, op):
+        with self._cond:
+            self._ensure_started(db)
+            deadline = time.monotonic() + WRITE_BEHIND_FULL_WAIT
+            while len(self._ops) >= WRITE_BEHIND_QUEUE_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise WriterBusy("Chat storage is falling behind; try again shortly", retry_after=2)
+                self._cond.wait(remaining)
+            self._ops.append(op)
+            self._pending[str(op["session_id"])] += 1
+            self._cond.notify_all()
+
+    def create_session(self, db, session_name, messages):
+        session_oid = ObjectId()
+        self._enqueue(db, {
+            "op": "create", "session_id": session_oid, "session_name": session_name,
+            "messages": _with_ids(messages), "created_at": datetime.now(),
+        })
+        return str(session_oid)
+
+    def append_messages(self, db, session_id, messages, set_fields=None):
+        self._enqueue(db, {
+            "op": "append", "session_id": ObjectId(session_id),
+            "messages": _with_ids(messages), "set_fields": set_fields or {},
+        })
+
+    def update_message(self, db, session_id, message_id, set_fields, unset_fields=None):
+        self._enqueue(db, {
+            "op": "update", "session_id": ObjectId(session_id), "message_id": message_id,
+            "set_fields": dict(set_fields), "unset_fields": list(unset_fields or []),
+        })
+
+    def delete_message(self, db, session_id, message_id):
+        self._enqueue(db, {"op": "delete", "session_id": ObjectId(session_id), "message_id": message_id})
+
+    def wait_for(self, db, session_ids, timeout=READ_WAIT_SECONDS):
+        """Block until the queued writes of `session_ids` are in Mongo (or `timeout`)."""
+        keys = [str(sid) for sid in session_ids]
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._ensure_started(db)
+            while any(self._pending[key] for key in keys):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    print("Write-behind: reading before pending writes were flushed")
+                    return False
+                self._urgent = True
+                self._cond.notify_all()
+                self._cond.wait(remaining)
+        return True
+
+    def _run(self):
+        backoff = 0.1
+        while True:
+            with self._cond:
+                while not self._ops:
+                    if self._closing:
+                        return
+                    self._cond.wait()
+                # Linger so that concurrent turns share a batch, unless a reader is waiting
+                if not (self._urgent or self._closing) and len(self._ops) < WRITE_BEHIND_BATCH_MAX:
+                    self._cond.wait(WRITE_BEHIND_FLUSH_MS / 1000)
+                self._urgent = False
+                batch = [self._ops.popleft() for _ in range(min(len(self._ops), WRITE_BEHIND_BATCH_MAX))]
+                self._inflight = batch
+
+            try:
+                with metrics.WRITE_BEHIND_FLUSH_SECONDS.time():
+                    _write_batch(self._db, batch)
+                backoff = 0.1
+            except Exception as e:
+                print(f"Write-behind flush of {len(batch)} writes failed, retrying: {e}")
+                with self._cond:
+                    self._inflight = []
+                    self._ops.extendleft(reversed(batch))
+                    if self._closing:
+                        return
+                    self._cond.wait(backoff)
+                backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
+                continue
+
+            with self._cond:
+                self._inflight = []
+                for op in batch:
+                    key = str(op["session_id"])
+                    self._pending[key] -= 1
+                    if not self._pending[key]:
+                        del self._pending[key]
+                self._cond.notify_all()
+
+    def close(self, timeout=WRITE_BEHIND_SHUTDOWN_TIMEOUT):
+        """Flush what is queued, then spill anything left to disk."""
+        if self._worker is None:
+            return
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._worker.join(timeout)
+        with self._cond:
+            # A batch still being written when the timeout hit is spilled as well;
+            # replaying it is safe because retries are idempotent (see above)
+            left = self._inflight + list(self._ops)
+            self._ops.clear()
+        if left:
+            self._spill(left)
+
+    def _spill(self, ops):
+        lines = "".join(json_util.dumps(op, json_options=SPILL_JSON_OPTIONS) + "\n" for op in ops)
+        # One appending write, so workers shutting down together don't interleave lines
+        with open(WRITE_BEHIND_SPILL_PATH, "a", encoding="utf-8") as f:
+            f.write(lines)
+        print(f"Write-behind: spilled {len(ops)} unwritten writes to {WRITE_BEHIND_SPILL_PATH}")
+
+    def _load_spill(self):
+        # Claim the file first: with several workers only one may replay it
+        claimed = f"{WRITE_BEHIND_SPILL_PATH}.{os.getpid()}.replaying"
+        try:
+            os.replace(WRITE_BEHIND_SPILL_PATH, claimed)
+        except FileNotFoundError:
+            return []
+        with open(claimed, encoding="utf-8") as f:
+            ops = [json_util.loads(line, json_options=SPILL_JSON_OPTIONS) for line in f if line.strip()]
+        # The ops are queued now and get spilled again if this process can't write them
+        os.remove(claimed)
+        print(f"Write-behind: replaying {len(ops)} writes spilled at the last shutdown")
+        return ops
+
+    def depth(self):
+        return len(self._ops)
+
+
+def _with_ids(messages):
+    """Copies of `messages` with an _id each, so a retried insert is a no-op."""
+    return [m if "_id" in m else {**m, "_id": ObjectId()} for m in messages]
+
+
+def _apply_update(doc, set_fields, unset_fields):
+    for field in unset_fields:
+        doc.pop(field, None)
+    doc.update(set_fields)
+
+
+def _write_batch(db, batch):
+    """Apply queued writes, in order per session, with unordered bulk operations."""
+    message_store.ensure_indexes(db)
+    creates = OrderedDict()
+    appends = OrderedDict()
+    new_messages = {}
+    updates = OrderedDict()
+    deletes = OrderedDict()
+
+    for op in batch:
+        session_oid = op["session_id"]
+        if op["op"] == "delete":
+            # A message inserted by this batch is still inserted first, then deleted
+            updates.pop(op["message_id"], None)
+            deletes[op["message_id"]] = session_oid
+            continue
+        if op["op"] == "update":
+            doc = new_messages.get(op["message_id"])
+            if doc is not None:
+                # Still being inserted by this batch: fold the update into the insert
+                _apply_update(doc, op["set_fields"], op["unset_fields"])
+                continue
+            update = updates.setdefault(op["message_id"], {"session_id": session_oid, "set": {}, "unset": set()})
+            update["unset"].difference_update(op["set_fields"])
+            update["unset"].update(op["unset_fields"])
+            for field in op["unset_fields"]:
+                update["set"].pop(field, None)
+            update["set"].update(op["set_fields"])
+            continue
+
+        copies = [dict(m) for m in op["messages"]]
+        new_messages.update((m["_id"], m) for m in copies)
+        if op["op"] == "create":
+            # Appends to it stay appends: on a retry the session may already
+            # be stored, and only an append's $inc keeps message_count right
+            creates[session_oid] = {"op": op, "messages": copies}
+        else:
+            append = appends.setdefault(session_oid, {"ops": [], "set_fields": {}})
+            append["ops"].append((op, copies))
+            append["set_fields"].update(op["set_fields"])
+
+    now = datetime.now()
+    message_docs = []
+    if creates:
+        sessions = []
+        for session_oid, create in creates.items():
+            messages = create["messages"]
+            sessions.append({
+                "_id": session_oid,
+                "session_name": create["op"]["session_name"],
+                "created_at": create["op"]["created_at"],
+                "updated_at": now,
+                "message_count": len(messages),
+                "preview": message_store._preview(messages),
+            })
+            message_docs.extend(message_store._message_docs(session_oid, messages, 0))
+        try:
+            db.sessions.insert_many(sessions, ordered=False)
+        except BulkWriteError as e:
+            # Sessions inserted by an earlier attempt of this batch
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    if appends:
+        legacy = db.sessions.find({"_id": {"$in": list(appends)}, "messages": {"$exists": True}}, {"_id": 1})
+        for session in legacy:
+            message_store.migrate_session(db, session["_id"])
+        for session_oid, append in appends.items():
+            # Reserve seqs only for ops that have none yet; a retried or replayed
+            # op keeps the ones its first attempt reserved
+            unreserved = [op for op, _ in append["ops"] if "first_seq" not in op]
+            count = sum(len(op["messages"]) for op in unreserved)
+            messages = [m for _, copies in append["ops"] for m in copies]
+            update = {"$set": {"updated_at": now, "preview": message_store._preview(messages), **append["set_fields"]}}
+            if count:
+                update["$inc"] = {"message_count": count}
+            session = db.sessions.find_one_and_update(
+                {"_id": session_oid}, update, projection={"message_count": 1}
+            )
+            if session is None:
+                # Deleted meanwhile; the synchronous path drops these too
+                continue
+            # The document as it was before the $inc
+            next_seq = session.get("message_count", 0)
+            for op in unreserved:
+                op["first_seq"] = next_seq
+                next_seq += len(op["messages"])
+            for op, copies in append["ops"]:
+                message_docs.extend(message_store._message_docs(session_oid, copies, op["first_seq"]))
+
+    message_store._insert_idempotent(db, message_docs)
+
+    if updates:
+        message_ops = []
+        session_previews = {}
+        for message_id, update in updates.items():
+            change = {}
+            if update["set"]:
+                change["$set"] = update["set"]
+            if update["unset"]:
+                change["$unset"] = {field: "" for field in update["unset"]}
+            if change:
+                message_ops.append(UpdateOne({"_id": message_id, "session_id": update["session_id"]}, change))
+            preview = session_previews.setdefault(update["session_id"], {"updated_at": now})
+            if "content" in update["set"]:
+                preview["preview"] = (update["set"]["content"] or "")[:message_store.PREVIEW_CHARS]
+        if message_ops:
+            db.messages.bulk_write(message_ops, ordered=False)
+        db.sessions.bulk_write(
+            [UpdateOne({"_id": oid}, {"$set": fields}) for oid, fields in session_previews.items()], ordered=False
+        )
+
+    if deletes:
+        db.messages.delete_many({"_id": {"$in": list(deletes)}})
+        for session_oid in set(deletes.values()):
+            message_store.refresh_preview(db, session_oid)
+
+
+writer = WriteBehind()
+metrics.WRITE_BEHIND_QUEUE.set_function(writer.depth)
+
+
+def create_session(db, session_name, messages):
+    """Like message_store.create_session; queued when WRITE_BEHIND is on."""
+    if WRITE_BEHIND:
+        return writer.create_session(db, session_name, messages)
+    return message_store.create_session(db, session_name, messages)
+
+
+def append_messages(db, session_id, messages, set_fields=None):
+    """Like message_store.append_messages, without the seq result when queued."""
+    if WRITE_BEHIND:
+        return writer.append_messages(db, session_id, messages, set_fields)
+    return message_store.append_messages(db, session_id, messages, set_fields)
+
+
+def update_message(db, session_id, message_id, set_fields, unset_fields=None):
+    if WRITE_BEHIND:
+        return writer.update_message(db, session_id, message_id, set_fields, unset_fields)
+    return message_store.update_message(db, session_id, message_id, set_fields, unset_fields)
+
+
+def delete_message(db, session_id, message_id):
+    if WRITE_BEHIND:
+        return writer.delete_message(db, session_id, message_id)
+    return message_store.delete_message(db, session_id, message_id)
+
+
+def wait_for(db, session_ids):
+    """Read-your-writes barrier before reading `session_ids`; a no-op without WRITE_BEHIND."""
+    if WRITE_BEHIND:
+        writer.wait_for(db, [sid for sid in session_ids if sid and sid != "1"])